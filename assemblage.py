@@ -78,41 +78,15 @@ class Assemblage(object):
         fire(Refresh(e))
         return e
 
-    @staticmethod
-    def Floor(x, y, z):
-        e = Entity.create()
-        Location.add_to(entity=e, x=x, y=y)
-        Depth.add_to(entity=e, z=z)
-        RenderData.add_to(entity=e, layer=BACK, glyph='.')
-        fire(Refresh(e))
-        AdjList.add_to(entity=e, neighbors=[])
-        EntityList.add_to(entity=e, entities=[])
-        return e
-
-    @staticmethod
-    def Wall(x, y, z):
-        e = Entity.create()
-        HP.add_to(entity=e, value=1)
-        Location.add_to(entity=e, x=x, y=y)
-        Depth.add_to(entity=e, z=z)
-        RenderData.add_to(entity=e, layer=BACK, glyph='#')
-        Collideable.add_to(entity=e, blocks=True)
-        AdjList.add_to(entity=e, neighbors=[])
-        EntityList.add_to(entity=e, entities=[])
-        OnDeath.add_to(entity=e, death_function=wall_death)
-        fire(Refresh(e))
-        return e
+    # Floors and walls are terrain (see terrain.py), not entities
+    # Stairs are drawn by the terrain too; the entity just holds the link
 
     @staticmethod
     def DownStair(x, y, z):
         e = Entity.create()
         Location.add_to(entity=e, x=x, y=y)
         Depth.add_to(entity=e, z=z)
-        RenderData.add_to(entity=e, layer=BACK, glyph='>')
-        AdjList.add_to(entity=e, neighbors=[])
-        EntityList.add_to(entity=e, entities=[])
         Descender.add_to(entity=e, down=None)
-        fire(Refresh(e))
         return e
 
     @staticmethod
@@ -120,11 +94,7 @@ class Assemblage(object):
         e = Entity.create()
         Location.add_to(entity=e, x=x, y=y)
         Depth.add_to(entity=e, z=z)
-        RenderData.add_to(entity=e, layer=BACK, glyph='<')
-        AdjList.add_to(entity=e, neighbors=[])
-        EntityList.add_to(entity=e, entities=[])
         Ascender.add_to(entity=e, up=None)
-        fire(Refresh(e))
         return e
 
     @staticmethod
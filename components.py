@@ -10,9 +10,16 @@ Example: something with a Player component will be affected by the
 Empty components are used to add behavior without any particular data
 attached to it beyond that an entity has that component.
 """
+import copy
+from collections.abc import MutableMapping
 from constants import *
 from entity import Entity
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class Component(object):
     """
@@ -20,11 +27,29 @@ class Component(object):
     Each holds a dict of entities of their type
     Has functionality to add, remove, get all entities with,
     and get all components of this type
+
+    Classes that set columnar = True and list their integer <fields> keep
+    the field values in a ColumnStore instead of on the instances when
+    COLUMNAR_STORAGE is on; the instances in the table are then just views
     """
+    columnar = False
+    fields = ()
+    store = None  # the class's ColumnStore, if it uses one
+    bound = None  # the ColumnStore an instance reads its fields from
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for field in cls.__dict__.get("fields", ()):
+            setattr(cls, field, column_property(field))
+
     @classmethod
     def initialize(cls):
         cls.table = {}
         cls.just_removed = []
+        cls.store = None
+        if cls.columnar and COLUMNAR_STORAGE and numpy is not None:
+            cls.store = ColumnStore(cls.fields)
+        Query.refresh_all(cls)
 
     @classmethod
     def add_to(cls, entity, *args, **kwargs):
@@ -32,7 +57,16 @@ class Component(object):
         Add a new instance of the component class with the arguments passed
         through
         """
-        cls.table[entity] = cls(*args, **kwargs)
+        if cls.store is not None:
+            component = cls.__new__(cls)
+            component.entity = entity
+            component.bound = cls.store
+            cls.store.allocate(entity)
+            component.__init__(*args, **kwargs)
+        else:
+            component = cls(*args, **kwargs)
+        cls.table[entity] = component
+        Query.notify(cls, entity)
 
     @classmethod
     def rm_from(cls, entity):
@@ -41,7 +75,23 @@ class Component(object):
         """
         component_removed = cls.table.pop(entity, None)
         if component_removed is not None:
+            if component_removed.bound is not None:
+                # keep the last values around for whoever reads just_removed
+                vars(component_removed).update(
+                    component_removed.bound.row_values(entity))
+                component_removed.bound = None
+                cls.store.free(entity)
             cls.just_removed.append((entity, component_removed))
+            Query.notify(cls, entity)
+
+    @staticmethod
+    def rm_all_from(entity):
+        """
+        Remove every component from the given entity
+        """
+        for component_class in get_all_children(Component):
+            if hasattr(component_class, "table"):
+                component_class.rm_from(entity)
 
     @classmethod
     def rm_group_from(cls, entity):
@@ -81,7 +131,7 @@ class Component(object):
         If entities=None: Get all components of this type
         Else: Get components for each entity passed in
         """
-        from collections import Iterable
+        from collections.abc import Iterable
         if entities is None:
             return list(cls.table.values())
         elif isinstance(entities, Iterable):
@@ -91,17 +141,19 @@ class Component(object):
     def entities_with(*component_classes):
         """
         Get all entities with all components given
+        The matching set is kept up to date by a cached Query, so this no
+        longer rebuilds anything per call
         """
-        valid = set(range(Entity.num_entities))
-        for c in component_classes:
-            valid = valid.intersection(set(c.table))
-
-        return list(v for v in valid)
+        return Query.cached(*component_classes).entities()
 
     def __str__(self):
+        values = dict(vars(self))
+        values.pop("entity", None)
+        values.pop("bound", None)
+        values.update((f, getattr(self, f)) for f in self.fields)
         return "{:<20}:".format(self.__class__.__name__) + \
             " ".join("{!s}: {!r} ".format(k, v)
-                     for k, v in sorted(vars(self).items()))
+                     for k, v in sorted(values.items()))
 
     @classmethod
     def table_str(cls):
@@ -116,7 +168,461 @@ class Component(object):
                 subclass.cleanup()
 
 
+def column_property(field):
+    """
+    Make a property that reads and writes <field> through the instance's
+    ColumnStore when it has one and through its __dict__ otherwise
+    """
+    def get(self):
+        if self.bound is None:
+            return self.__dict__[field]
+        return self.bound.get(self.entity, field)
+
+    def set(self, value):
+        if self.bound is None:
+            self.__dict__[field] = value
+        else:
+            self.bound.set(self.entity, field, value)
+
+    return property(get, set)
+
+
+class ColumnStore(object):
+    """
+    Struct-of-arrays storage for one columnar component class
+    Rows are dense: row i of every column belongs to entity_of[i], and
+    row_of[entity] is the row of an entity or -1
+    Removing swaps the last row into the hole, so column(f) is always a
+    contiguous view that systems can do array math on
+    row_of is indexed by Entity.index(), so it stays as small as the
+    number of entity slots rather than the size of the id space
+    A forked store shares its arrays with the one it was forked from; each
+    of them copies a column the first time it writes to it (own())
+    """
+    shared = False
+
+    def __init__(self, fields, capacity=64):
+        self.fields = fields
+        self.size = 0
+        self.columns = {f: numpy.zeros(capacity, dtype=numpy.int64)
+                        for f in fields}
+        self.entity_of = numpy.full(capacity, -1, dtype=numpy.int64)
+        self.row_of = numpy.full(capacity, -1, dtype=numpy.int64)
+
+    def fork(self):
+        twin = ColumnStore.__new__(ColumnStore)
+        vars(twin).update(vars(self))
+        twin.columns = dict(self.columns)
+        self.shared = twin.shared = True
+        self.owned, twin.owned = set(), set()
+        return twin
+
+    def own(self, field=None):
+        """
+        Stop sharing arrays with a fork before writing to them: just the
+        column of <field>, or every array when rows come, go or move
+        """
+        if not self.shared:
+            return
+        for f in self.fields if field is None else (field,):
+            if f not in self.owned:
+                self.columns[f] = self.columns[f].copy()
+                self.owned.add(f)
+        if field is None:
+            self.entity_of = self.entity_of.copy()
+            self.row_of = self.row_of.copy()
+            self.shared = False
+
+    def allocate(self, entity):
+        self.own()
+        index = Entity.index(entity)
+        if index >= len(self.row_of):
+            grown = numpy.full(max(index + 1, 2 * len(self.row_of)), -1,
+                               dtype=numpy.int64)
+            grown[:len(self.row_of)] = self.row_of
+            self.row_of = grown
+        if self.row_of[index] >= 0:
+            return self.row_of[index]
+
+        if self.size == len(self.entity_of):
+            capacity = 2 * self.size
+            for f in self.fields:
+                self.columns[f] = numpy.resize(self.columns[f], capacity)
+            self.entity_of = numpy.resize(self.entity_of, capacity)
+
+        row = self.size
+        self.size += 1
+        self.entity_of[row] = entity
+        self.row_of[index] = row
+        return row
+
+    def fill(self, entities, columns):
+        """
+        Replace every row at once with <entities> (in row order) and the
+        matching arrays in <columns>, e.g. when loading a snapshot
+        """
+        entities = numpy.asarray(entities, dtype=numpy.int64)
+        size = len(entities)
+        capacity = max(64, size)
+        self.shared = False
+        indices = entities & Entity.INDEX_MASK
+        self.size = size
+        self.entity_of = numpy.full(capacity, -1, dtype=numpy.int64)
+        self.entity_of[:size] = entities
+        self.row_of = numpy.full(max(64, int(indices.max()) + 1 if size else 0),
+                                 -1, dtype=numpy.int64)
+        self.row_of[indices] = numpy.arange(size)
+        for f in self.fields:
+            self.columns[f] = numpy.zeros(capacity, dtype=numpy.int64)
+            self.columns[f][:size] = columns[f]
+
+    def free(self, entity):
+        self.own()
+        index = Entity.index(entity)
+        row = self.row_of[index]
+        last = self.size - 1
+        if row != last:
+            moved = self.entity_of[last]
+            for column in self.columns.values():
+                column[row] = column[last]
+            self.entity_of[row] = moved
+            self.row_of[Entity.index(moved)] = row
+        self.entity_of[last] = -1
+        self.row_of[index] = -1
+        self.size -= 1
+
+    def get(self, entity, field):
+        return int(self.columns[field][self.row_of[entity & Entity.INDEX_MASK]])
+
+    def set(self, entity, field, value):
+        self.own(field)
+        self.columns[field][self.row_of[entity & Entity.INDEX_MASK]] = value
+
+    def row_values(self, entity):
+        return {f: self.get(entity, f) for f in self.fields}
+
+    def entities(self):
+        """
+        Entity ids in row order (a view, copy it before adding or removing)
+        """
+        return self.entity_of[:self.size]
+
+    def column(self, field):
+        """
+        The live values of <field> in row order (a writable view)
+        """
+        self.own(field)
+        return self.columns[field][:self.size]
+
+    def rows(self, entities):
+        """
+        Rows for an array of entities, -1 for entities not in this store
+        """
+        entities = numpy.asarray(entities, dtype=numpy.int64)
+        indices = entities & Entity.INDEX_MASK
+        rows = numpy.full(len(entities), -1, dtype=numpy.int64)
+        known = indices < len(self.row_of)
+        rows[known] = self.row_of[indices[known]]
+        # a stale id shares its slot with a live entity; don't hand that out
+        stale = rows >= 0
+        stale[stale] = self.entity_of[rows[stale]] != entities[stale]
+        rows[stale] = -1
+        return rows
+
+    def has(self, entities):
+        """
+        Boolean mask of which of an array of entities are in this store
+        """
+        return self.rows(entities) >= 0
+
+    def gather(self, entities, field, missing=-1):
+        """
+        Values of <field> for an array of entities, <missing> where absent
+        """
+        rows = self.rows(entities)
+        values = numpy.full(len(rows), missing, dtype=numpy.int64)
+        present = rows >= 0
+        values[present] = self.columns[field][rows[present]]
+        return values
+
+
+class CowDict(MutableMapping):
+    """
+    A dict for a forked world
+    It reads through to <base>, a dict nobody writes to any more, and keeps
+    its own additions, replacements and deletions on top (in local and
+    removed), so forking one costs nothing and writing to it costs no more
+    than writing to a dict. Values come from base as they are: replace a
+    value instead of changing it in place unless owns(key)
+    Keys come out in the order a plain dict would have them in
+    """
+    MAX_DEPTH = 8  # dicts layered deeper than this are flattened
+
+    def __init__(self, base):
+        self.base = base
+        self.local = {}
+        self.removed = set()  # keys of base that were deleted
+        self.size = len(base)
+        if isinstance(base, CowDict):
+            self.depth = base.depth + 1
+            self.read = base.peek
+        else:
+            self.depth = 1
+            self.read = base.__getitem__
+
+    @staticmethod
+    def frozen(d):
+        """
+        What both sides of a fork can read through to, once neither of them
+        writes to <d> any more
+        """
+        if not isinstance(d, CowDict):
+            return d
+        if not d.local and not d.removed:
+            return d.base
+        if d.depth >= CowDict.MAX_DEPTH:
+            return d.flatten()
+        return d
+
+    @staticmethod
+    def owns(d, key):
+        """
+        See if the value under <key> in <d> (a dict or a CowDict) belongs to
+        it alone, so it can be changed in place
+        """
+        return not isinstance(d, CowDict) or key in d.local
+
+    def peek(self, key):
+        """
+        Look a value up without copying it
+        """
+        if key in self.local:
+            return self.local[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.read(key)
+
+    def flatten(self):
+        return {key: self.peek(key) for key in self}
+
+    def __contains__(self, key):
+        return key in self.local or \
+            (key in self.base and key not in self.removed)
+
+    def __getitem__(self, key):
+        return self.peek(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.size += 1
+        self.local[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        if key in self.base:
+            self.removed.add(key)
+        self.size -= 1
+
+    def __iter__(self):
+        base, local, removed = self.base, self.local, self.removed
+        for key in base:
+            if key not in removed:
+                yield key
+        # added since the fork (a removed key of base that came back goes
+        # to the end, as it would in a dict)
+        for key in local:
+            if key not in base or key in removed:
+                yield key
+
+    def __len__(self):
+        return self.size
+
+
+class CowTable(CowDict):
+    """
+    A component table for a forked world
+    Components are changed in place all over the systems, so unlike a plain
+    CowDict it copies an entry out of base the first time that entry is
+    looked up at all; a fork still only pays for the components it touches.
+    Copied views are bound to <store>, the fork's own ColumnStore
+    """
+    def __init__(self, base, store=None):
+        super().__init__(base)
+        self.store = store
+
+    def __getitem__(self, entity):
+        if entity in self.local:
+            return self.local[entity]
+        component = self.peek(entity)
+        memo = {}
+        if component.bound is not None:
+            memo[id(component.bound)] = self.store
+        component = self.local[entity] = copy.deepcopy(component, memo)
+        return component
+
+
+class Query(object):
+    """
+    A registered view over every entity that has all of <components>,
+    none of <without>, and any of <optional>
+    The matching set is updated as components are added and removed, so
+    iterating a query costs O(matches) instead of O(entities)
+    version goes up whenever the matching set changes, or a member gains or
+    loses one of the optional components
+    Iterating yields (entity, component, component, ...) tuples with the
+    components in the order given (required first, then optional, which are
+    None when missing)
+    """
+    registry = []
+    by_component = {}
+    cache = {}
+
+    def __init__(self, *components, without=(), optional=()):
+        if not components:
+            raise ValueError("A query needs at least one required component")
+        self.components = components
+        self.without = tuple(without)
+        self.optional = tuple(optional)
+        self.joined = self.components + self.optional
+        self.entities_set = set()
+        self.shared = False  # entities_set is shared with a forked world
+        self.version = 0
+        self.arrivals = None
+
+        Query.registry.append(self)
+        for c in self.components + self.without + self.optional:
+            Query.by_component.setdefault(c, []).append(self)
+        self.refresh()
+
+    @staticmethod
+    def cached(*components):
+        """
+        Get (or register) the plain query over <components>
+        """
+        key = frozenset(components)
+        query = Query.cache.get(key)
+        if query is None:
+            query = Query.cache[key] = Query(*components)
+        return query
+
+    @staticmethod
+    def notify(component_class, entity):
+        """
+        Called whenever <entity> gains or loses a <component_class>
+        """
+        for query in Query.by_component.get(component_class, ()):
+            query.check(entity)
+
+    @staticmethod
+    def refresh_all(component_class):
+        """
+        Rebuild every query that depends on <component_class>
+        """
+        for query in Query.by_component.get(component_class, ()):
+            query.refresh()
+
+    def matches(self, entity):
+        return (all(entity in getattr(c, "table", ())
+                    for c in self.components) and
+                not any(entity in getattr(c, "table", ())
+                        for c in self.without))
+
+    def watch(self):
+        """
+        Start recording the entities that join this query, beginning with
+        the ones already in it
+        """
+        self.arrivals = sorted(self.entities_set)
+
+    def take_arrivals(self):
+        """
+        Get the entities that joined since the last call, oldest first
+        (some may have left again since)
+        """
+        arrivals, self.arrivals = self.arrivals, []
+        return arrivals
+
+    def check(self, entity):
+        if self.matches(entity):
+            if entity not in self.entities_set:
+                self.own()
+                self.entities_set.add(entity)
+                self.version += 1
+                if self.arrivals is not None:
+                    self.arrivals.append(entity)
+            else:
+                # what it has of the optional components changed
+                self.version += 1
+        elif entity in self.entities_set:
+            self.own()
+            self.entities_set.discard(entity)
+            self.version += 1
+
+    def own(self):
+        # copied whole so the fork walks its members in the parent's order
+        if self.shared:
+            self.entities_set = set(self.entities_set)
+            self.shared = False
+
+    def refresh(self):
+        """
+        Recompute the matching set from scratch
+        """
+        tables = sorted((getattr(c, "table", {}) for c in self.components),
+                        key=len)
+        self.entities_set = set(e for e in tables[0]
+                                if self.matches(e))
+        self.shared = False
+        self.version += 1
+
+    def entities(self):
+        """
+        Get all matching entities
+        """
+        return list(self.entities_set)
+
+    def __contains__(self, entity):
+        return entity in self.entities_set
+
+    def __len__(self):
+        return len(self.entities_set)
+
+    def __iter__(self):
+        # iterate over a snapshot; systems add and remove components
+        # while walking queries
+        for entity in list(self.entities_set):
+            if entity not in self.entities_set:
+                continue
+            yield (entity,) + tuple(c.table.get(entity, None)
+                                    for c in self.joined)
+
+
 class Location(Component):
+    columnar = True
+    fields = ("x", "y", "last_x", "last_y")
+
+    @classmethod
+    def initialize(cls):
+        super().initialize()
+        SpatialIndex.initialize()
+
+    @classmethod
+    def add_to(cls, entity, *args, **kwargs):
+        super().add_to(entity, *args, **kwargs)
+        SpatialIndex.sync(entity)
+
+    @classmethod
+    def rm_from(cls, entity):
+        super().rm_from(entity)
+        SpatialIndex.sync(entity)
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -146,6 +652,19 @@ class Location(Component):
 
 
 class Depth(Component):
+    columnar = True
+    fields = ("z", "last_z")
+
+    @classmethod
+    def add_to(cls, entity, *args, **kwargs):
+        super().add_to(entity, *args, **kwargs)
+        SpatialIndex.sync(entity)
+
+    @classmethod
+    def rm_from(cls, entity):
+        super().rm_from(entity)
+        SpatialIndex.sync(entity)
+
     def __init__(self, z):
         self.z = z
         self.last_z = z
@@ -155,6 +674,135 @@ class Depth(Component):
         return d1.z == d2.z
 
 
+class SpatialIndex(object):
+    """
+    Hash of (z, x, y) -> entities standing there
+    Everything with both a Location and a Depth is indexed
+    Anything that changes a Location or Depth (add_to, rm_from, and the
+    execute/undo of movement events) must call sync() afterwards
+    levels holds the same entities bucketed by depth alone, and version
+    goes up every time anything moves
+    In a forked world the three are CowDicts, and sync() copies a bucket
+    before changing it
+    """
+    @staticmethod
+    def initialize():
+        SpatialIndex.cells = {}
+        SpatialIndex.where = {}
+        SpatialIndex.levels = {}
+        SpatialIndex.version = 0
+
+    @staticmethod
+    def sync(entity):
+        """
+        Move <entity> to the cell its components say it is in
+        """
+        location = Location.get_component(entity)
+        depth = Depth.get_component(entity)
+        key = None
+        if location is not None and depth is not None:
+            key = (depth.z, location.x, location.y)
+
+        old_key = SpatialIndex.where.get(entity, None)
+        if key == old_key:
+            return
+        SpatialIndex.version += 1
+
+        cells, levels = SpatialIndex.cells, SpatialIndex.levels
+        old_z = None if old_key is None else old_key[0]
+        z = None if key is None else key[0]
+        if old_key is not None:
+            cell = SpatialIndex.bucket(cells, old_key)
+            cell.discard(entity)
+            if not cell:
+                del cells[old_key]
+            if z != old_z:
+                SpatialIndex.bucket(levels, old_z).discard(entity)
+            del SpatialIndex.where[entity]
+
+        if key is not None:
+            SpatialIndex.bucket(cells, key).add(entity)
+            if z != old_z:
+                SpatialIndex.bucket(levels, z).add(entity)
+            SpatialIndex.where[entity] = key
+
+    @staticmethod
+    def bucket(index, key):
+        """
+        The set under <key> in <index> (cells or levels), made first if
+        there isn't one, and copied first if a forked world shares it
+        """
+        bucket = index.get(key, None)
+        if bucket is None:
+            bucket = index[key] = set()
+        elif not CowDict.owns(index, key):
+            bucket = index[key] = set(bucket)
+        return bucket
+
+    @staticmethod
+    def at(z, x, y):
+        """
+        Get every entity in this cell
+        """
+        return sorted(SpatialIndex.cells.get((z, x, y), ()))
+
+    @staticmethod
+    def on_level(z):
+        """
+        Get every entity on level z
+        """
+        return sorted(SpatialIndex.levels.get(z, ()))
+
+    disks = {}
+
+    @staticmethod
+    def disk_offsets(radius):
+        """
+        Get the (dx, dy) offsets with dx**2 + dy**2 < radius**2, worked out
+        once per radius
+        """
+        offsets = SpatialIndex.disks.get(radius, None)
+        if offsets is None:
+            offsets = SpatialIndex.disks[radius] = [
+                (dx, dy) for dx in range(-radius, radius + 1)
+                for dy in range(-radius, radius + 1)
+                if dx * dx + dy * dy < radius * radius]
+        return offsets
+
+    @staticmethod
+    def in_radius(z, x, y, radius):
+        """
+        Get every entity on level z less than <radius> away from (x, y)
+        """
+        offsets = SpatialIndex.disk_offsets(radius)
+        on_level = SpatialIndex.levels.get(z, ())
+        if len(on_level) < len(offsets):
+            # fewer entities on the level than cells in the disk
+            where = SpatialIndex.where
+            r2 = radius * radius
+            return sorted(e for e in on_level
+                          if (where[e][1] - x) ** 2 + (where[e][2] - y) ** 2
+                          < r2)
+
+        cells = SpatialIndex.cells
+        found = []
+        for dx, dy in offsets:
+            found.extend(cells.get((z, x + dx, y + dy), ()))
+        return sorted(found)
+
+    @staticmethod
+    def in_rect(z, x0, y0, x1, y1):
+        """
+        Get every entity with x0 <= x <= x1 and y0 <= y <= y1 on level z
+        """
+        cells = SpatialIndex.cells
+        found = []
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                found.extend(cells.get((z, x, y), ()))
+        return sorted(found)
+
+
 class RenderData(Component):
     """
     Layer: there are five layers (defined in constants.py)
@@ -188,6 +836,18 @@ class Camera(AI):
     active = None
 
 
+class Asleep(Component):
+    """
+    NPCs too far from the player to matter right now
+    Sleepers are left out of the active queries until something wakes
+    them. decay_turns is how many turns of TIME decay their level had seen
+    when they dozed off, so the decay they slept through can be charged
+    when they wake up
+    """
+    def __init__(self, decay_turns):
+        self.decay_turns = decay_turns
+
+
 class Collideable(Component):
     """
     Collideables that run into each other will shoot out collision events
@@ -201,29 +861,46 @@ class Stat(Component):
     """
     Anything with one value is a stat...?
     """
+    fields = ("value",)
+
     def __init__(self, value):
         self.value = value
 
 
 class Timer(Component):
+    """
+    Fires every <max_time> turns (see Scheduler)
+    """
+    columnar = True
+    fields = ("max_time",)
+
     def __init__(self, max_time):
-        self.time = 0
         self.max_time = max_time
 
 
 class HP(Stat):
+    columnar = True
+
+
+class Speed(Stat):
+    """
+    Percent of normal speed: 200 acts twice a turn, 50 every other turn
+    """
     pass
 
 
 class ATK(Stat):
-    pass
+    columnar = True
 
 
 class DEF(Stat):
-    pass
+    columnar = True
 
 
 class TIME(Stat):
+    columnar = True
+    fields = ("value", "decay_rate")
+
     def __init__(self, value, decay_rate):
         self.value = value
         self.decay_rate = decay_rate
@@ -262,23 +939,6 @@ class OnDeath(Component):
         self.death_function = death_function
 
 
-# Tile components below?
-class AdjList(Component):
-    """
-    Contain adjacency data for a tile
-    """
-    def __init__(self, neighbors):
-        self.neighbors = neighbors
-
-
-class EntityList(Component):
-    """
-    Contain whatever entity lives here
-    """
-    def __init__(self, entities=[]):
-        self.entities = entities
-
-
 class Descender(Component):
     """
     Stairs that go down
@@ -26,6 +26,38 @@ RENDER_LAYERS = [BACK, MID_BACK, MID, MID_FRONT, FRONT]
 
 FOV_RADIUS = 7
 
+# NPCs further than this from the player (or on another level) sleep
+WAKE_RADIUS = 10
+# how far the x pulse can be heard
+NOISE_RADIUS = 14
+
+# Game time: an action at normal speed (Speed 100) takes this many ticks
+ACTION_TICKS = 100
+
+# Terrain tile types (see terrain.py)
+TILE_FLOOR = 0
+TILE_WALL = 1
+TILE_RUBBLE = 2
+TILE_DOWN_STAIR = 3
+TILE_UP_STAIR = 4
+TILE_CORPSE = 5
+TILE_GLYPHS = [".", "#", ",", ">", "<", "%"]
+TILE_WALKABLE = [True, False, True, True, True, True]
+TILE_OPAQUE = [False, True, False, False, False, False]
+WALL_HP = 1
+
+# Keep Location, Depth, HP, ATK, DEF, TIME and Timer in numpy columns
+# (only takes effect if numpy is installed). Off by default: at this
+# game's scale the per-access cost of the column views outweighs what the
+# array math in update_TIME and the batch resolvers saves
+COLUMNAR_STORAGE = False
+
+# Resolve moves, and Damage, TimeDamage, Heal, TIMEPulse and TIMESiphon, a
+# whole queue at a time: moves simultaneously, the rest with array math on
+# the HP and TIME columns (that part needs COLUMNAR_STORAGE and falls back
+# to one event at a time otherwise)
+BATCH_RESOLUTION = True
+
 HELP_STRING = """hjklyubn: movement
 z: ranged attack
 x: circular attack
@@ -1,5 +1,7 @@
+from entity import Entity
 from components import *
 from events import *
+from terrain import Terrain
 
 
 def player_death(entity):
@@ -10,22 +12,18 @@ def player_death(entity):
 
 
 def npc_death(entity):
-    HP.rm_from(entity)
-    ATK.rm_from(entity)
-    DEF.rm_from(entity)
-    TIME.rm_from(entity)
-    AI.rm_group_from(entity)
-    RenderData.get_component(entity).glyph = "%"
-    RenderData.get_component(entity).layer = MID
-    Prop.add_to(entity)
-    if Collideable.get_component(entity) is not None:
-        Collideable.get_component(entity).blocks = False
-    fire(Refresh(entity))
+    # the corpse is left as terrain, so the entity's id can be recycled
+    location = Location.get_component(entity)
+    depth = Depth.get_component(entity)
+    if location is not None and depth is not None:
+        x, y, z = location.x, location.y, depth.z
+        if Terrain.tile(z, x, y) in (TILE_FLOOR, TILE_RUBBLE):
+            Terrain.writable(z).set_tile(x, y, TILE_CORPSE)
+            fire(TileChanged(x, y, z))
+    Entity.destroy(entity)
 
 
-def wall_death(entity):
-    HP.rm_from(entity)
-    TIME.rm_from(entity)
-    RenderData.get_component(entity).glyph = ","
-    Collideable.rm_from(entity)
-    fire(Refresh(entity))
+def wall_death(x, y, z):
+    # walls are terrain, so this one takes a cell instead of an entity
+    Terrain.writable(z).set_tile(x, y, TILE_RUBBLE)
+    fire(TileChanged(x, y, z))
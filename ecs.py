@@ -1,11 +1,12 @@
-import curses
 import logging
+import random
 
 from constants import *
 from components import *
 from events import *
 from assemblage import Assemblage
 from systems import *
+from frontend import *
 
 ################################################################
 #                                                              #
@@ -17,61 +18,153 @@ from systems import *
 class Engine(object):
     component_classes = get_all_children(Component)
     event_classes = get_all_children(Event)
-    stdscr = None
-    pads = None
+    renderer = None
+    input = None
+
+    # The turn pipeline: each phase's events are handled in this order,
+    # and the phases are dispatched in main() in this order
+    phases = [
+        ("movement", [(ActorChangeLevel, update_depth),
+                      (ActorMoved, update_physics),
+                      (Collision, update_collisions),
+                      (Ascent, resolve_level_change),
+                      (Descent, resolve_level_change),
+                      (ActorPickup, resolve_action)]),
+        ("resolution", [(Heal, resolve_heals),
+                        (TIMEPulse, resolve_special),
+                        (Damage, resolve_damage),
+                        (TimeDamage, resolve_time_damage),
+                        (TileDamage, resolve_tile_damage),
+                        (TIMESiphon, resolve_time_siphon)]),
+        ("death", [(Death, resolve_death)]),
+    ]
+    # With BATCH_RESOLUTION these replace the handlers above for their
+    # classes and take a whole queue at a time
+    batch_handlers = {
+        ActorMoved: resolve_moves_batch,
+        Heal: resolve_heals_batch,
+        TIMEPulse: resolve_special_batch,
+        Damage: resolve_damage_batch,
+        TimeDamage: resolve_time_damage_batch,
+        TIMESiphon: resolve_time_siphon_batch,
+    }
+
+    seed = None
 
     @staticmethod
-    def initialize():
+    def initialize(seed=None, workers=1, lazy=False, renderer=None,
+                   input=None):
+        """
+        Set up a new game
+        The same seed always gives the same dungeon, whatever the number of
+        workers used to generate its levels
+        With lazy=True only the top level is built now, and the rest are
+        built on the first descent into them
+        renderer and input default to curses; to run headless pass e.g.
+        NullRenderer() and ScriptedInput(keys) (see frontend.py)
+        """
+        if seed is None:
+            seed = random.randrange(2**32)
+        Engine.seed = seed
+
+        Entity.initialize()
+
         for cc in Engine.component_classes:
             cc.initialize()
 
         for ec in Engine.event_classes:
             ec.initialize()
 
-        Engine.render_data = initialize_render()
+        EventBus.initialize()
+        for phase, subscriptions in Engine.phases:
+            EventBus.declare_phase(phase, [ec for ec, _ in subscriptions])
+            for event_class, handler in subscriptions:
+                if BATCH_RESOLUTION and event_class in Engine.batch_handlers:
+                    EventBus.subscribe_batch(
+                        event_class, Engine.batch_handlers[event_class])
+                else:
+                    EventBus.subscribe(event_class, handler)
+
+        if renderer is None:
+            renderer = CursesRenderer()
+        if input is None:
+            if not isinstance(renderer, CursesRenderer):
+                raise ValueError("A headless engine needs an input")
+            input = CursesInput(renderer.stdscr)
+        Engine.renderer = renderer
+        Engine.input = input
+
+        Terrain.initialize()
+        FlowField.initialize()
+        PathFinder.initialize()
+        FOV.initialize()
+        NearestEnemies.initialize()
+        Activity.initialize()
+        Scheduler.initialize()
+        # NPCs act as soon as they are awake, Timers after a full period
+        Scheduler.register("act", awake_npcs, lambda npc: 0, npc_act)
+        Scheduler.register("timer", timers, timer_period, timer_fired)
 
         Assemblage.Camera()
 
-        dungeon = [generate_map(l) for l in range(10)]
+        Dungeon.initialize(seed, lazy)
+
+        if lazy:
+            random.seed(seed)
+            Dungeon.ensure_level(DUNGEON_TOP)
+        else:
+            dungeon = generate_dungeon(DUNGEON_DEPTH + 1, seed, workers)
+
+            for i in range(DUNGEON_DEPTH + 1):
+                Dungeon.add_level(dungeon[i], depth=i)
 
-        for i in range(10):
-            actualize_map(dungeon[i], depth=i)
+            link_stairs()
 
-        link_stairs()
+            # everything after map generation runs off the master seed too
+            random.seed(seed)
 
-        populate_dungeon(dungeon, DUNGEON_DEPTH)
+            populate_dungeon(DUNGEON_DEPTH)
+
+        # draws the terrain for the first frame
+        fire(ClearScreen())
+
+    @staticmethod
+    def settle():
+        # resolve what the actors of one tick did before the next tick runs
+        EventBus.dispatch("movement")
+        EventBus.dispatch("resolution")
+        EventBus.dispatch("death")
 
     @staticmethod
-    def main():
+    def main(max_turns=None):
+        """
+        Play until the game is won, lost or quit, or for at most max_turns
+        turns, and return the number of turns played
+        """
         turn_count = 0
         while not (Quit.peek() or Win.peek()):
+            if max_turns is not None and turn_count >= max_turns:
+                break
             logging.info("===TURN %s===", turn_count)
-            update_timers()
-            while (ActorMoved.queue or ActorPickup.queue or
-                   Descent.queue or Ascent.queue):
-                update_depth()
-                update_physics()
-                update_collisions()
-                resolve_level_change()
-                resolve_special()
-                resolve_action()  # not sure what order these all happen in
-            resolve_heals()
-            resolve_damage()
-            resolve_time_siphon()
+            EventBus.dispatch("movement")
+            EventBus.dispatch("resolution")
+            update_activity()
             update_TIME()
-            resolve_death()
+            EventBus.dispatch("death")
             update_camera()
-            update_render(*Engine.render_data)
-            fire_player_action(Engine.render_data[0].getkey())
+            Engine.renderer.draw()
+            fire_player_action(Engine.input.getkey())
             while AbortTurn.pop():
-                fire_player_action(Engine.stdscr.getkey())
-            fire_npc_actions()
+                fire_player_action(Engine.input.getkey())
+            # everything else due before the player's next action
+            Scheduler.advance(Scheduler.delay(Player.active), Engine.settle)
             cleanup_removed_components()
             turn_count += 1
+        return turn_count
 
     @staticmethod
     def terminate():
-        terminate_render(Engine.render_data[0])
+        Engine.renderer.terminate()
         if Win.pop() is not None:
             print("Yon win!")
         else:
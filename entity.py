@@ -1,10 +1,76 @@
+from collections import deque
+
+
 class Entity(object):
     """
     Entities are just numbers!
+    The low INDEX_BITS bits of an entity are the slot it lives in and the
+    rest is that slot's generation, which is bumped when the entity is
+    destroyed. Slots are recycled, but a stale id held somewhere (in an
+    event, on a stair) never equals the id of the slot's new owner.
     """
-    num_entities = 0
+    INDEX_BITS = 20
+    INDEX_MASK = (1 << INDEX_BITS) - 1
+
+    num_entities = 0  # slots handed out so far, i.e. the size of the id space
+    generations = []
+    free = deque([])
+    shared = False  # generations and free are shared with a forked world
+
+    @staticmethod
+    def initialize():
+        Entity.num_entities = 0
+        Entity.generations = []
+        Entity.free = deque([])
+        Entity.shared = False
+
+    @staticmethod
+    def own():
+        if Entity.shared:
+            Entity.generations = list(Entity.generations)
+            Entity.free = deque(Entity.free)
+            Entity.shared = False
 
     @staticmethod
     def create():
-        Entity.num_entities += 1
-        return Entity.num_entities - 1
+        Entity.own()
+        if Entity.free:
+            index = Entity.free.popleft()
+        else:
+            index = Entity.num_entities
+            Entity.num_entities += 1
+            Entity.generations.append(0)
+        return index | (Entity.generations[index] << Entity.INDEX_BITS)
+
+    @staticmethod
+    def destroy(entity):
+        """
+        Strip every component from <entity> and recycle its slot
+        """
+        if not Entity.alive(entity):
+            return
+        from components import Component
+        Component.rm_all_from(entity)
+        Entity.own()
+        index = Entity.index(entity)
+        Entity.generations[index] += 1
+        Entity.free.append(index)
+
+    @staticmethod
+    def index(entity):
+        return entity & Entity.INDEX_MASK
+
+    @staticmethod
+    def generation(entity):
+        return entity >> Entity.INDEX_BITS
+
+    @staticmethod
+    def alive(entity):
+        """
+        See if <entity> still refers to a live entity
+        """
+        if entity is None:
+            return False
+        index = Entity.index(entity)
+        return (index < Entity.num_entities and
+                Entity.generations[index] == Entity.generation(entity))
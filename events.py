@@ -10,21 +10,61 @@ from components import *
 class Event(object):
     """
     Events are used to pass messages between systems
+    Events are slotted and pooled per class: pop() and drain() hand what
+    they returned last time back to the pool, and constructing an event
+    reuses a pooled instance when there is one. So an event popped from a
+    queue is only valid until the next pop() or drain() of that class; copy
+    out any field that has to live longer, and never keep a reference to an
+    event in another.
     """
+    __slots__ = ()
+    POOL_MAX = 4096
+
+    def __new__(cls, *args, **kwargs):
+        pool = cls.pool
+        return pool.pop() if pool else object.__new__(cls)
+
     @classmethod
     def initialize(cls):
         # deque is optimized!
         from collections import deque
         cls.queue = deque([])
+        cls.pool = []
+        cls.last = None
+        cls.drained = []
 
     @classmethod
     def add(cls, event):
         cls.queue.append(event)
 
+    @classmethod
+    def release(cls):
+        # whatever pop() or drain() handed out before is finished with
+        pool = cls.pool
+        if cls.last is not None:
+            if len(pool) < cls.POOL_MAX:
+                pool.append(cls.last)
+            cls.last = None
+        if cls.drained:
+            pool.extend(cls.drained[:max(0, cls.POOL_MAX - len(pool))])
+            cls.drained = []
+
     @classmethod
     def pop(cls):
         # when we want to be done with the event
-        return cls.queue.popleft() if cls.queue else None
+        cls.release()
+        cls.last = cls.queue.popleft() if cls.queue else None
+        return cls.last
+
+    @classmethod
+    def drain(cls):
+        """
+        Pop every queued event at once, as a list
+        """
+        cls.release()
+        cls.drained = list(cls.queue)
+        cls.queue.clear()
+        return cls.drained
 
     @classmethod
     def peek(cls):
@@ -32,7 +72,78 @@ class Event(object):
         return cls.queue[0] if cls.queue else None
 
 
+class EventBus(object):
+    """
+    Routes events to the systems that handle them
+    Systems subscribe handlers to event classes, and phases name an ordered
+    list of event classes. dispatch(phase) sweeps the phase's classes in
+    order, handing one event from each non-empty queue to its handlers,
+    until every queue in the phase is empty; empty queues cost nothing.
+    Re-entrancy: handlers never run inside other handlers. Anything fired
+    while handling is just queued. If it belongs to the phase being
+    dispatched, a later sweep of the same dispatch picks it up; otherwise
+    it waits for its own phase. Calling dispatch from a handler is an error.
+    Batch handlers take the whole queue at once instead: when a class has
+    any, each sweep drains its queue into a list and passes them that.
+    """
+    @staticmethod
+    def initialize():
+        EventBus.handlers = {}
+        EventBus.batch_handlers = {}
+        EventBus.phases = {}
+        EventBus.dispatching = None
+
+    @staticmethod
+    def subscribe(event_class, handler):
+        EventBus.handlers.setdefault(event_class, []).append(handler)
+
+    @staticmethod
+    def subscribe_batch(event_class, handler):
+        EventBus.batch_handlers.setdefault(event_class, []).append(handler)
+
+    @staticmethod
+    def declare_phase(name, event_classes):
+        EventBus.phases[name] = list(event_classes)
+
+    @staticmethod
+    def dispatch(name):
+        if EventBus.dispatching is not None:
+            raise RuntimeError("dispatch({!r}) called while dispatching {!r}"
+                               .format(name, EventBus.dispatching))
+        EventBus.dispatching = name
+        try:
+            work = [(ec, EventBus.handlers.get(ec, ()),
+                     EventBus.batch_handlers.get(ec))
+                    for ec in EventBus.phases[name]]
+            busy = True
+            while busy:
+                busy = False
+                for event_class, handlers, batch_handlers in work:
+                    if batch_handlers:
+                        events = event_class.drain()
+                        if not events:
+                            continue
+                        busy = True
+                        for handler in batch_handlers:
+                            handler(events)
+                        for event in events:
+                            for handler in handlers:
+                                handler(event)
+                        continue
+
+                    event = event_class.pop()
+                    if event is None:
+                        continue
+                    busy = True
+                    for handler in handlers:
+                        handler(event)
+        finally:
+            EventBus.dispatching = None
+
+
 class ActorMoved(Event):
+    __slots__ = ("x", "y", "entity")
+
     def __init__(self, x, y, entity):
         self.x = x
         self.y = y
@@ -44,14 +155,23 @@ class ActorMoved(Event):
         entity_location.last_y = entity_location.y
         entity_location.x = self.x
         entity_location.y = self.y
+        SpatialIndex.sync(self.entity)
 
     def undo(self):
-        entity_location = Location.get_component(entity=self.entity)
+        ActorMoved.revert(self.entity)
+
+    @staticmethod
+    def revert(entity):
+        # put an entity back where it was before its last move
+        entity_location = Location.get_component(entity=entity)
         entity_location.x = entity_location.last_x
         entity_location.y = entity_location.last_y
+        SpatialIndex.sync(entity)
 
 
 class ActorPickup(Event):
+    __slots__ = ("x", "y", "entity")
+
     def __init__(self, x, y, entity):
         self.x = x
         self.y = y
@@ -59,6 +179,8 @@ class ActorPickup(Event):
 
 
 class ActorChangeLevel(Event):
+    __slots__ = ("z", "entity")
+
     def __init__(self, z, entity):
         self.z = z
         self.entity = entity
@@ -67,86 +189,129 @@ class ActorChangeLevel(Event):
         entity_depth = Depth.get_component(entity=self.entity)
         entity_depth.last_z = entity_depth.z
         entity_depth.z = self.z
+        SpatialIndex.sync(self.entity)
 
     def undo(self):
         entity_depth = Depth.get_component(entity=self.entity)
         entity_depth.last_z = entity_depth.z
+        SpatialIndex.sync(self.entity)
 
 
 class TIMEPulse(Event):
+    __slots__ = ("actor", "target")
+
     def __init__(self, actor, target):
         self.actor = actor
         self.target = target
 
 
 class TIMESiphon(Event):
+    __slots__ = ("actor", "target")
+
     def __init__(self, actor, target):
         self.actor = actor
         self.target = target
 
 
 class Collision(Event):
-    def __init__(self, initiator, receiver, action):
+    __slots__ = ("initiator", "receiver")
+
+    def __init__(self, initiator, receiver):
         self.initiator = initiator
         self.receiver = receiver
-        self.action = action
 
 
 class Damage(Event):
+    __slots__ = ("dmg", "target")
+
     def __init__(self, dmg, target):
         self.dmg = dmg
         self.target = target
 
 
 class TimeDamage(Event):
+    __slots__ = ("dmg", "target")
+
     def __init__(self, dmg, target):
         self.dmg = dmg
         self.target = target
 
 
+class TileDamage(Event):
+    __slots__ = ("dmg", "x", "y", "z")
+
+    def __init__(self, dmg, x, y, z):
+        self.dmg = dmg
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class TileChanged(Event):
+    __slots__ = ("x", "y", "z")
+
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
 class Death(Event):
-    def __init__(self, target):
+    """
+    cause is what killed the target: "damage" (HP), "time" (TimeDamage)
+    or "decay" (TIME running out on its own)
+    """
+    __slots__ = ("target", "cause")
+
+    def __init__(self, target, cause=None):
         self.target = target
+        self.cause = cause
 
 
 class Refresh(Event):
+    __slots__ = ("entity", "erase")
+
     def __init__(self, entity, erase=False):
         self.entity = entity
         self.erase = False
 
 
 class ClearScreen(Event):
-    pass
+    __slots__ = ()
 
 
 class Descent(Event):
-    pass
+    __slots__ = ()
 
 
 class Ascent(Event):
-    pass
+    __slots__ = ()
 
 
 class Log(Event):
+    __slots__ = ("log_str",)
+
     def __init__(self, log_str):
         self.log_str = log_str
 
 
 class Win(Event):
-    pass
+    __slots__ = ()
 
 
 class AbortTurn(Event):
-    pass
+    __slots__ = ()
 
 
 class Heal(Event):
+    __slots__ = ("actor",)
+
     def __init__(self, actor):
         self.actor = actor
 
 
 class Quit(Event):
-    pass
+    __slots__ = ()
 
 
 def fire(event):
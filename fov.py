@@ -0,0 +1,102 @@
+"""
+Field of view
+=============
+Recursive shadowcasting over the terrain's opaque masks. A result is a
+boolean numpy array over the level, indexed [x, y] like the tile grids,
+and is cached per (x, y, radius) until the level's terrain changes.
+"""
+import numpy
+from terrain import *
+
+# (xx, xy, yx, yy) for each of the eight octants
+OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+           (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+
+class FOV(object):
+    """
+    Who can see what
+    A cell is in view if light from the viewer's cell reaches it without
+    passing through an opaque tile and it is less than <radius> away
+    (the same circle all_in_radius uses)
+    The arrays handed out are shared through the cache; don't write to
+    them
+    """
+    CACHE_MAX = 4096
+
+    @staticmethod
+    def initialize():
+        FOV.caches = {}
+
+    @staticmethod
+    def visible(z, x, y, radius):
+        """
+        Get the boolean [x, y] array of cells visible from (x, y)
+        """
+        grid = Terrain.level(z)
+        cached = FOV.caches.get(z, None)
+        if (cached is None or cached[0] != grid.version or
+                len(cached[1]) > FOV.CACHE_MAX):
+            cached = FOV.caches[z] = (grid.version, {})
+
+        key = (x, y, radius)
+        seen = cached[1].get(key, None)
+        if seen is None:
+            seen = cached[1][key] = FOV.compute(grid, x, y, radius)
+        return seen
+
+    @staticmethod
+    def can_see(z, x, y, radius, target_x, target_y):
+        return bool(FOV.visible(z, x, y, radius)[target_x, target_y])
+
+    @staticmethod
+    def compute(grid, x, y, radius):
+        seen = numpy.zeros((grid.width, grid.height), dtype=bool)
+        seen[x, y] = True
+        for octant in OCTANTS:
+            FOV.cast_light(grid, seen, x, y, radius, 1, 1.0, 0.0, *octant)
+        return seen
+
+    @staticmethod
+    def cast_light(grid, seen, cx, cy, radius, row, start, end,
+                   xx, xy, yx, yy):
+        """
+        Light one octant from <row> outward between slopes <start> and <end>,
+        recursing past each run of opaque cells
+        """
+        if start < end:
+            return
+        opaque = grid.opaque
+        radius2 = radius * radius
+        new_start = start
+        for j in range(row, radius + 1):
+            dx, dy = -j - 1, -j
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                map_x, map_y = cx + dx * xx + dy * xy, cy + dx * yx + dy * yy
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                elif end > left_slope:
+                    break
+
+                inside = grid.in_bounds(map_x, map_y)
+                if inside and dx * dx + dy * dy < radius2:
+                    seen[map_x, map_y] = True
+                # the edge of the map blocks light like a wall
+                blocks = not inside or opaque[map_x, map_y]
+                if blocked:
+                    if blocks:
+                        new_start = right_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif blocks and j < radius:
+                    blocked = True
+                    FOV.cast_light(grid, seen, cx, cy, radius, j + 1,
+                                   start, left_slope, xx, xy, yx, yy)
+                    new_start = right_slope
+            if blocked:
+                break
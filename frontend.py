@@ -0,0 +1,210 @@
+"""
+Frontend
+========
+Where the engine gets its keys from and where its frames go. Engine only
+ever calls getkey() on an input and draw()/terminate() on a renderer, so
+the game can be played in curses or run headless: driven by a script, a
+bot policy or a replay, and drawn to memory or not at all.
+"""
+import json
+import random
+from constants import *
+from events import *
+from systems import initialize_render, update_render, terminate_render
+
+# every key fire_player_action does something with, apart from quitting
+GAME_KEYS = "hjklyubnxzg<>"
+
+
+################################################################
+#                                                              #
+#                             INPUT                            #
+#                                                              #
+################################################################
+
+
+class CursesInput(object):
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+
+    def getkey(self):
+        return self.stdscr.getkey()
+
+
+class ScriptedInput(object):
+    """
+    Plays a fixed list of keys, then quits
+    """
+    def __init__(self, keys):
+        self.keys = iter(keys)
+
+    def getkey(self):
+        return next(self.keys, 'q')
+
+
+class PolicyInput(object):
+    """
+    Asks <policy>, any callable taking no arguments, for every key
+    A policy can look at the world through the components, as systems do
+    """
+    def __init__(self, policy):
+        self.policy = policy
+
+    def getkey(self):
+        return self.policy()
+
+
+def random_policy(seed=None, keys=GAME_KEYS):
+    """
+    A policy that mashes random keys, with its own RNG so it doesn't
+    disturb the game's
+    """
+    rng = random.Random(seed)
+    return lambda: rng.choice(keys)
+
+
+class RecordingInput(object):
+    """
+    Passes keys through from another input and remembers them
+    """
+    def __init__(self, source):
+        self.source = source
+        self.keys = []
+
+    def getkey(self):
+        key = self.source.getkey()
+        self.keys.append(key)
+        return key
+
+    def save(self, path, seed):
+        with open(path, "w") as f:
+            json.dump({"seed": seed, "keys": self.keys}, f)
+
+
+class ReplayInput(ScriptedInput):
+    """
+    Plays back a game saved by RecordingInput.save; start the engine with
+    the recorded seed to get the same game
+    """
+    def __init__(self, path):
+        with open(path) as f:
+            recording = json.load(f)
+        self.seed = recording["seed"]
+        super().__init__(recording["keys"])
+
+
+################################################################
+#                                                              #
+#                           RENDERERS                          #
+#                                                              #
+################################################################
+
+
+class CursesRenderer(object):
+    def __init__(self):
+        self.stdscr, self.pads, self.msg_log, self.stat_log = \
+            initialize_render()
+
+    def draw(self):
+        update_render(self.stdscr, self.pads, self.msg_log, self.stat_log)
+
+    def terminate(self):
+        terminate_render(self.stdscr)
+
+
+class NullRenderer(object):
+    """
+    Draws nothing; just throws away what the render system would use
+    """
+    def draw(self):
+        for event_class in (ClearScreen, TileChanged, Refresh, Log):
+            event_class.drain()
+
+    def terminate(self):
+        pass
+
+
+class FramePad(object):
+    """
+    Enough of a curses window/pad for update_render, kept in memory
+    Text added without a position (the message log) is kept in lines,
+    scrolling like the real one does
+    """
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.clear()
+
+    def clear(self):
+        self.cells = [[' '] * self.width for _ in range(self.height)]
+        self.lines = []
+
+    def addch(self, y, x, ch):
+        self.cells[y][x] = ch
+
+    def delch(self, y, x):
+        row = self.cells[y]
+        del row[x]
+        row.append(' ')
+
+    def insch(self, y, x, ch):
+        row = self.cells[y]
+        row.insert(x, ch)
+        row.pop()
+
+    def addstr(self, *args):
+        if len(args) == 1:
+            self.lines.extend(args[0].splitlines())
+            del self.lines[:-self.height]
+            return
+        y, x, text = args
+        row = self.cells[y]
+        text = text[:self.width - x]
+        row[x:x + len(text)] = text
+
+    def overlay(self, dest, sminrow, smincol,
+                dminrow, dmincol, dmaxrow, dmaxcol):
+        # like curses, blanks don't overwrite what's underneath
+        for dy in range(dminrow, min(dmaxrow, dest.height - 1) + 1):
+            sy = sminrow + dy - dminrow
+            if not 0 <= sy < self.height:
+                continue
+            src, dst = self.cells[sy], dest.cells[dy]
+            for dx in range(dmincol, min(dmaxcol, dest.width - 1) + 1):
+                sx = smincol + dx - dmincol
+                if 0 <= sx < self.width and src[sx] != ' ':
+                    dst[dx] = src[sx]
+
+    def refresh(self):
+        pass
+
+    def text(self):
+        return ["".join(row) for row in self.cells]
+
+
+class FrameBufferRenderer(object):
+    """
+    Runs the real render system against FramePads, so the frames can be
+    inspected (screen(), stats(), messages()) without a terminal
+    """
+    def __init__(self):
+        self.stdscr = FramePad(SCREEN_HEIGHT + 2, SCREEN_WIDTH + 2)
+        self.pads = [FramePad(MAP_HEIGHT + 1, MAP_WIDTH + 1)
+                     for _ in range(NUM_RENDER_LAYERS)]
+        self.msg_log = FramePad(MSG_LOG_HEIGHT, MSG_LOG_WIDTH)
+        self.stat_log = FramePad(STAT_LOG_HEIGHT, STAT_LOG_WIDTH)
+
+    def draw(self):
+        update_render(self.stdscr, self.pads, self.msg_log, self.stat_log)
+
+    def screen(self):
+        return self.stdscr.text()
+
+    def stats(self):
+        return self.stat_log.text()
+
+    def messages(self):
+        return self.msg_log.lines
+
+    def terminate(self):
+        pass
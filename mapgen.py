@@ -1,8 +1,14 @@
 from components import *
 from constants import *
 from assemblage import *
+from terrain import *
 from random import randint, choice
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def seed(the_map, wall_percentage):
     for x in range(MAP_WIDTH):
@@ -53,8 +59,8 @@ def add_stairs(the_map, depth):
     while num_downs + num_ups > 0:
         if depth == DUNGEON_DEPTH:
             num_downs = 0
-        for x in range(MAP_WIDTH):
-            for y in range(MAP_HEIGHT):
+        for x in range(len(the_map)):
+            for y in range(len(the_map[x])):
                 if the_map[x][y] == ".":
                     if randint(0, 99) < 1 and num_downs > 0:
                         the_map[x][y] = ">"
@@ -74,34 +80,20 @@ def border(the_map):
         the_map[MAP_WIDTH - 1][j] = "#"
 
 
-def create_adjacencies(the_map):
+def create_tile_grid(the_map, depth):
     """
-    Requires that the map be composed of entities that are in the AdjList table
+    Convert a map of #, ., > and < into the level's TileGrid
+    Stairs also become entities, since they link levels together
     """
-    for x in range(MAP_WIDTH):
-        for y in range(MAP_HEIGHT):
-            adj_list = AdjList.get_component(the_map[x][y])
-            for i in range(x - 1, x + 2):
-                for j in range(y - 1, y + 2):
-                    if not (i == x and j == y):
-                        if in_bounds(i, j):
-                            adj_list.neighbors.append(the_map[i][j])
+    grid = TileGrid.from_map(the_map)
+    Terrain.add_level(depth, grid)
 
+    for x, y in zip(*numpy.nonzero(grid.tiles == TILE_DOWN_STAIR)):
+        Assemblage.DownStair(int(x), int(y), depth)
+    for x, y in zip(*numpy.nonzero(grid.tiles == TILE_UP_STAIR)):
+        Assemblage.UpStair(int(x), int(y), depth)
 
-def create_real_tiles(the_map, depth):
-    """
-    Convert a map of # and . into Walls and Floors
-    """
-    for x in range(MAP_WIDTH):
-        for y in range(MAP_HEIGHT):
-            if the_map[x][y] == "#":
-                the_map[x][y] = Assemblage.Wall(x, y, depth)
-            elif the_map[x][y] == ".":
-                the_map[x][y] = Assemblage.Floor(x, y, depth)
-            elif the_map[x][y] == ">":
-                the_map[x][y] = Assemblage.DownStair(x, y, depth)
-            elif the_map[x][y] == "<":
-                the_map[x][y] = Assemblage.UpStair(x, y, depth)
+    return grid
 
 
 def cellular_automata(wall_percentage, smooth_iters, smooth_threshold):
@@ -167,3 +159,65 @@ def double_cellular_automata(wall_percentage, smooth_iters, smooth_threshold):
     map2 = cellular_automata(wall_percentage, smooth_iters,
                              smooth_threshold)
     return xor(map1, map2)
+
+
+# Vectorized versions of the above
+# These work on boolean numpy grids indexed [x, y] (True is a wall) and
+# handle any map size; grid_to_map turns the result back into # and .
+
+
+def random_generator():
+    """
+    A numpy generator seeded from the random module, so seeding random
+    also pins down the vectorized map generators
+    """
+    return numpy.random.default_rng(randint(0, 2**32 - 1))
+
+
+def seed_grid(wall_percentage, width=MAP_WIDTH, height=MAP_HEIGHT, rng=None):
+    if rng is None:
+        rng = random_generator()
+    return rng.integers(0, 100, size=(width, height)) < wall_percentage
+
+
+def smooth_grid(grid, iters, threshold):
+    """
+    Same rule as smooth(), with the neighbor counts done as nine shifted
+    sums over a zero-padded copy of the grid
+    """
+    width, height = grid.shape
+    for i in range(iters):
+        padded = numpy.zeros((width + 2, height + 2), dtype=numpy.int16)
+        padded[1:-1, 1:-1] = grid
+        # smooth() never counts tile (0, 0) as anyone's neighbor
+        padded[1, 1] = 0
+        # the tile itself counts once on top of the 3x3 window
+        wall_count = grid.astype(numpy.int16)
+        for dx in range(3):
+            for dy in range(3):
+                wall_count += padded[dx:dx + width, dy:dy + height]
+        grid = wall_count >= threshold
+    return grid
+
+
+def grid_to_map(grid):
+    """
+    Turn a boolean grid back into a list-of-lists map of # and .
+    """
+    return numpy.where(grid, "#", ".").tolist()
+
+
+def cellular_automata_grid(wall_percentage, smooth_iters, smooth_threshold,
+                           width=MAP_WIDTH, height=MAP_HEIGHT, rng=None):
+    grid = seed_grid(wall_percentage, width, height, rng)
+    return smooth_grid(grid, smooth_iters, smooth_threshold)
+
+
+def double_cellular_automata_grid(wall_percentage, smooth_iters,
+                                  smooth_threshold, width=MAP_WIDTH,
+                                  height=MAP_HEIGHT, rng=None):
+    # xor()'s table works out to "wall wherever the second map is floor",
+    # so the first map never matters: make one grid and invert it
+    grid = cellular_automata_grid(wall_percentage, smooth_iters,
+                                  smooth_threshold, width, height, rng)
+    return ~grid
@@ -0,0 +1,186 @@
+"""
+Pathfinding
+===========
+Routing over the terrain grids in terrain.py. Everything here works on
+cells and the grids' adjacency, never on component tables, and caches its
+results against the grid's version so terrain changes invalidate them.
+"""
+from collections import deque
+from heapq import heappush, heappop
+from math import sqrt
+import numpy
+from terrain import *
+
+DIAGONAL_COST = sqrt(2)
+
+
+class FlowField(object):
+    """
+    One breadth-first distance map per level toward a goal cell (the
+    player's, in practice), shared by every NPC on that level
+    Along with the distances it keeps, for every cell, the neighbor one
+    step closer to the goal, so picking a step is a single lookup
+    A level's field is only rebuilt when its goal moves or its terrain
+    changes
+    """
+    @staticmethod
+    def initialize():
+        FlowField.fields = {}
+
+    @staticmethod
+    def get(z, goal_x, goal_y):
+        """
+        Get (distance, downhill) arrays over level z's cells for this goal
+        Unreachable cells have distance -1 and downhill -1
+        """
+        grid = Terrain.level(z)
+        key = (goal_x, goal_y, grid.version)
+        cached = FlowField.fields.get(z, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        field = FlowField.build(grid, goal_x, goal_y)
+        FlowField.fields[z] = (key, field)
+        return field
+
+    @staticmethod
+    def build(grid, goal_x, goal_y):
+        indptr, indices = grid.adjacency()
+        size = grid.width * grid.height
+        distance = numpy.full(size, -1, dtype=numpy.int64)
+        downhill = numpy.full(size, -1, dtype=numpy.int64)
+
+        goal = grid.cell(goal_x, goal_y)
+        distance[goal] = 0
+        frontier = deque([goal])
+        while frontier:
+            cell = frontier.popleft()
+            next_distance = distance[cell] + 1
+            for neighbor in indices[indptr[cell]:indptr[cell + 1]].tolist():
+                if distance[neighbor] < 0:
+                    distance[neighbor] = next_distance
+                    downhill[neighbor] = cell
+                    frontier.append(neighbor)
+        return distance, downhill
+
+    @staticmethod
+    def step(z, goal_x, goal_y, x, y):
+        """
+        Get the cell to move to from (x, y) to get closer to the goal, or
+        None if the goal can't be reached from there
+        """
+        grid = Terrain.level(z)
+        distance, downhill = FlowField.get(z, goal_x, goal_y)
+        next_cell = downhill[grid.cell(x, y)]
+        if next_cell < 0:
+            return None
+        return grid.coords(int(next_cell))
+
+
+def octile(x1, y1, x2, y2):
+    """
+    Distance between two cells with 8-way moves, diagonals costing sqrt(2)
+    """
+    dx = abs(x1 - x2)
+    dy = abs(y1 - y2)
+    return max(dx, dy) + (DIAGONAL_COST - 1) * min(dx, dy)
+
+
+class PathFinder(object):
+    """
+    A* between arbitrary cells on a level, with octile costs matching the
+    8-way movement in fire_player_action
+    Paths are cached by (start, goal), and every cell along a found path
+    remembers its next step toward that goal, so something walking a path
+    gets each later step from the cache instead of searching again
+    A level's caches are thrown away as soon as its terrain version moves,
+    e.g. when wall_death opens up a new cell
+    """
+    CACHE_MAX = 4096
+
+    @staticmethod
+    def initialize():
+        PathFinder.caches = {}
+
+    @staticmethod
+    def cache(z):
+        """
+        Get level z's (paths, steps) caches, emptied if the terrain changed
+        """
+        version = Terrain.level(z).version
+        cached = PathFinder.caches.get(z, None)
+        if (cached is None or cached[0] != version or
+                len(cached[2]) > PathFinder.CACHE_MAX):
+            cached = PathFinder.caches[z] = (version, {}, {})
+        return cached[1], cached[2]
+
+    @staticmethod
+    def find_path(z, start, goal):
+        """
+        Get the list of cells to walk from <start> to <goal> (start itself
+        not included), or None if there's no way there
+        """
+        paths, steps = PathFinder.cache(z)
+        key = (start, goal)
+        if key in paths:
+            return paths[key]
+
+        path = PathFinder.search(Terrain.level(z), start, goal)
+        paths[key] = path
+        if path:
+            for here, there in zip([start] + path, path):
+                steps[(here, goal)] = there
+        return path
+
+    @staticmethod
+    def next_step(z, start, goal):
+        """
+        Get the next cell on the way from <start> to <goal>, or None
+        """
+        paths, steps = PathFinder.cache(z)
+        step = steps.get((start, goal), None)
+        if step is None:
+            path = PathFinder.find_path(z, start, goal)
+            step = path[0] if path else None
+        return step
+
+    @staticmethod
+    def search(grid, start, goal):
+        if not (grid.in_bounds(*goal) and grid.walkable[goal]):
+            return None
+        if start == goal:
+            return []
+
+        indptr, indices = grid.adjacency()
+        start_cell = grid.cell(*start)
+        goal_cell = grid.cell(*goal)
+        goal_x, goal_y = goal
+
+        came_from = {start_cell: None}
+        cost = {start_cell: 0}
+        frontier = [(octile(start[0], start[1], goal_x, goal_y), start_cell)]
+        while frontier:
+            _, cell = heappop(frontier)
+            if cell == goal_cell:
+                break
+            x, y = grid.coords(cell)
+            for neighbor in indices[indptr[cell]:indptr[cell + 1]].tolist():
+                i, j = grid.coords(neighbor)
+                step_cost = 1 if i == x or j == y else DIAGONAL_COST
+                new_cost = cost[cell] + step_cost
+                if new_cost < cost.get(neighbor, new_cost + 1):
+                    cost[neighbor] = new_cost
+                    came_from[neighbor] = cell
+                    heappush(frontier,
+                             (new_cost + octile(i, j, goal_x, goal_y),
+                              neighbor))
+        else:
+            return None
+
+        path = []
+        cell = goal_cell
+        while cell != start_cell:
+            path.append(grid.coords(cell))
+            cell = came_from[cell]
+        path.reverse()
+        return path
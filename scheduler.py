@@ -0,0 +1,106 @@
+"""
+Scheduler
+=========
+Who acts when. Game time is counted in ticks, and things that act on their
+own (NPCs, timers) wait in a heap keyed by the tick of their next action,
+so a turn only touches what is actually due in it.
+"""
+import heapq
+from components import *
+
+
+class Scheduler(object):
+    """
+    A heap of (time, seq, entity, kind) entries
+    Each kind is registered with a query and a handler. Entities joining
+    the query are enrolled with start(entity) ticks to go; when an entry
+    comes due its handler runs and returns the ticks until the entity's
+    next entry (or None for no next entry)
+    Entries are dropped lazily: one whose entity has left the query, or
+    that has been replaced by a newer entry for the same entity and kind,
+    is skipped when it comes up instead of being dug out of the heap
+    Entries due at the same tick run together, in the order they were
+    scheduled, and advance() settles the events they fire before moving on
+    to a later tick
+    A forked world shares the heap until either world changes it
+    """
+    shared = False
+
+    @staticmethod
+    def initialize():
+        Scheduler.now = 0
+        Scheduler.heap = []
+        Scheduler.shared = False
+        Scheduler.seq = 0
+        Scheduler.current = {}
+        Scheduler.kinds = {}
+
+    @staticmethod
+    def register(kind, query, start, handler):
+        query.watch()
+        Scheduler.kinds[kind] = (query, start, handler)
+
+    @staticmethod
+    def delay(entity):
+        """
+        Ticks between two actions of <entity>
+        """
+        speed = Speed.get_component(entity)
+        if speed is None or speed.value <= 0:
+            return ACTION_TICKS
+        return max(1, ACTION_TICKS * 100 // speed.value)
+
+    @staticmethod
+    def own():
+        if Scheduler.shared:
+            Scheduler.heap = list(Scheduler.heap)
+            Scheduler.shared = False
+
+    @staticmethod
+    def schedule(entity, kind, ticks):
+        Scheduler.own()
+        Scheduler.seq += 1
+        Scheduler.current[entity, kind] = Scheduler.seq
+        heapq.heappush(Scheduler.heap,
+                       (Scheduler.now + ticks, Scheduler.seq, entity, kind))
+
+    @staticmethod
+    def enroll():
+        for kind, (query, start, _) in Scheduler.kinds.items():
+            for entity in query.take_arrivals():
+                if entity in query:
+                    Scheduler.schedule(entity, kind, start(entity))
+
+    @staticmethod
+    def advance(ticks, settle):
+        """
+        Run everything due in the next <ticks> ticks, calling settle()
+        between ticks to resolve the events fired so far
+        The events of the last tick run are left for the caller to settle
+        """
+        end = Scheduler.now + ticks
+        Scheduler.own()
+        heap = Scheduler.heap
+        first = True
+        Scheduler.enroll()
+        while heap and heap[0][0] < end:
+            Scheduler.now = heap[0][0]
+            if not first:
+                settle()
+                Scheduler.enroll()
+            first = False
+
+            while heap and heap[0][0] == Scheduler.now:
+                _, seq, entity, kind = heapq.heappop(heap)
+                if Scheduler.current.get((entity, kind)) != seq:
+                    continue
+                query, _, handler = Scheduler.kinds[kind]
+                if entity not in query:
+                    del Scheduler.current[entity, kind]
+                    continue
+                next_ticks = handler(entity)
+                if next_ticks is None:
+                    del Scheduler.current[entity, kind]
+                else:
+                    Scheduler.schedule(entity, kind, next_ticks)
+        Scheduler.now = end
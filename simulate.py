@@ -0,0 +1,167 @@
+"""
+Simulate
+========
+Play lots of seeded games headless, spread over a process pool, and
+stream back one record per game, for balance testing:
+
+    python simulate.py --games 10000 --workers 8 --out runs.jsonl
+
+Every record is a dict with the game's seed, outcome ("win", "lose",
+"quit" or "timeout"), turns played, deepest level the player reached,
+deaths by cause ({"damage": ..., "time": ..., "decay": ...}) and what
+killed the player (or None).
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from constants import *
+from components import *
+from events import *
+from frontend import *
+from ecs import Engine
+
+
+def make_input(seed, policy, keys):
+    if policy == "random":
+        return PolicyInput(random_policy(seed, keys))
+    if policy == "script":
+        # the script is played over and over rather than quitting at its end
+        return PolicyInput(itertools.cycle(keys).__next__)
+    raise ValueError("Unknown policy {!r}".format(policy))
+
+
+def play(seed, policy="random", keys=GAME_KEYS, max_turns=1000, lazy=False):
+    """
+    Play one game and return its record
+    Games are built eagerly by default, like Engine.initialize() builds
+    them. lazy=True starts faster, but lazily built levels are populated
+    from the game's RNG mid-game, so the same seed plays out differently
+    and the stats aren't comparable with eager games
+    """
+    Engine.initialize(seed=seed, lazy=lazy, renderer=NullRenderer(),
+                      input=make_input(seed, policy, keys))
+
+    record = {"seed": seed, "max_depth": DUNGEON_TOP, "deaths": Counter(),
+              "player_death": None}
+    dead = set()
+
+    def count_death(d):
+        # an entity can be hit by more than one thing on its way out
+        if d.target in dead:
+            return
+        dead.add(d.target)
+        record["deaths"][d.cause] += 1
+        if d.target == Player.active:
+            record["player_death"] = d.cause
+
+    def track_depth(_):
+        record["max_depth"] = max(record["max_depth"],
+                                  Depth.get_component(Player.active).z)
+
+    EventBus.subscribe(Death, count_death)
+    EventBus.subscribe(Descent, track_depth)
+
+    record["turns"] = Engine.main(max_turns)
+    if Win.peek() is not None:
+        record["outcome"] = "win"
+    elif record["player_death"] is not None:
+        record["outcome"] = "lose"
+    elif Quit.peek() is not None:
+        record["outcome"] = "quit"
+    else:
+        record["outcome"] = "timeout"
+    record["deaths"] = dict(record["deaths"])
+    return record
+
+
+def play_many(seeds, **options):
+    return [play(seed, **options) for seed in seeds]
+
+
+def simulate(seeds, workers=1, chunk_size=16, **options):
+    """
+    Play a game for every seed and yield the records as they finish
+    (in seed order with one worker, in whatever order they finish with
+    more). options are passed on to play()
+    Each worker process runs one game at a time, so the class-level game
+    state never sees two games at once
+    """
+    seeds = list(seeds)
+    if workers <= 1:
+        for seed in seeds:
+            yield play(seed, **options)
+        return
+
+    chunks = [seeds[i:i + chunk_size]
+              for i in range(0, len(seeds), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(play_many, chunk, **options)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            for record in future.result():
+                yield record
+
+
+def summarize(records):
+    outcomes = Counter()
+    deaths = Counter()
+    player_deaths = Counter()
+    turns = depth = 0
+    for record in records:
+        outcomes[record["outcome"]] += 1
+        deaths.update(record["deaths"])
+        if record["player_death"] is not None:
+            player_deaths[record["player_death"]] += 1
+        turns += record["turns"]
+        depth += record["max_depth"]
+    games = max(1, sum(outcomes.values()))
+    return {"games": sum(outcomes.values()),
+            "outcomes": dict(outcomes),
+            "mean_turns": turns / games,
+            "mean_max_depth": depth / games,
+            "deaths": dict(deaths),
+            "player_deaths": dict(player_deaths)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max-turns", type=int, default=1000)
+    parser.add_argument("--policy", choices=["random", "script"],
+                        default="random")
+    parser.add_argument("--keys", default=GAME_KEYS,
+                        help="keys the policy picks from, or the script")
+    parser.add_argument("--lazy", action="store_true",
+                        help="build levels on first descent (faster, but "
+                             "plays different games than the real engine)")
+    parser.add_argument("--out", help="write the records here as JSON lines")
+    args = parser.parse_args(argv)
+
+    seeds = range(args.first_seed, args.first_seed + args.games)
+    records = []
+    out = open(args.out, "w") if args.out else None
+    try:
+        for record in simulate(seeds, workers=args.workers,
+                               policy=args.policy, keys=args.keys,
+                               max_turns=args.max_turns,
+                               lazy=args.lazy):
+            records.append(record)
+            if out is not None:
+                out.write(json.dumps(record) + "\n")
+    finally:
+        if out is not None:
+            out.close()
+
+    json.dump(summarize(records), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
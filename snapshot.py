@@ -0,0 +1,369 @@
+"""
+Snapshots
+=========
+Save the whole game to one binary file and load it back. Everything that
+can't be worked out again is stored: the entity allocator, every component
+table, the pending events, the terrain, the dungeon, the scheduler, the
+activity counters and the RNG. Caches (paths, flow fields, FOV, nearest
+enemies) are left out and rebuilt on demand.
+
+The file is a small header, then raw little-endian numpy arrays ("blobs",
+each aligned to ALIGN bytes), then a JSON manifest saying where each blob
+is and how the tables are put together out of them. Tables are stored a
+column per field: integer columns as blobs, anything else (glyphs, death
+functions, inventories...) as JSON values in the manifest.
+
+    save("run.snap")
+    load("run.snap")       # into an engine that has been initialized
+    Snapshot("run.snap")   # memory-mapped, for looking around in
+"""
+import importlib
+import json
+import random
+import struct
+from collections import deque
+
+import numpy
+from constants import *
+from components import *
+from events import *
+from entity import Entity
+from terrain import Terrain, TileGrid
+from pathfinding import FlowField, PathFinder
+from fov import FOV
+from scheduler import Scheduler
+from systems import NearestEnemies, Activity, Dungeon
+from ecs import Engine
+
+MAGIC = b"7DRLSNAP"
+FORMAT_VERSION = 1
+# magic, format version, (unused), manifest offset, manifest length
+HEADER = struct.Struct("<8sIIQQ")
+ALIGN = 16
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def encode(value):
+    """
+    Turn a component or event field into something JSON can hold
+    """
+    if value is None or type(value) in (bool, int, float, str):
+        return value
+    if isinstance(value, numpy.integer):
+        return int(value)
+    if callable(value) and hasattr(value, "__qualname__"):
+        return {"fn": "{}:{}".format(value.__module__, value.__qualname__)}
+    if isinstance(value, dict):
+        return {"dict": [[encode(k), encode(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return {type(value).__name__: [encode(v) for v in value]}
+    raise SnapshotError("Can't snapshot {!r}".format(value))
+
+
+def decode(value):
+    if not isinstance(value, dict):
+        return value
+    (kind, content), = value.items()
+    if kind == "fn":
+        module, qualname = content.split(":")
+        found = importlib.import_module(module)
+        for name in qualname.split("."):
+            found = getattr(found, name)
+        return found
+    if kind == "dict":
+        return {decode(k): decode(v) for k, v in content}
+    if kind == "tuple":
+        return tuple(decode(v) for v in content)
+    return [decode(v) for v in content]
+
+
+class SnapshotWriter(object):
+    def __init__(self):
+        self.blobs = {}
+        self.arrays = []
+        self.offset = self.aligned(HEADER.size)
+
+    @staticmethod
+    def aligned(offset):
+        return -(-offset // ALIGN) * ALIGN
+
+    def array(self, name, values, dtype="<i8"):
+        array = numpy.ascontiguousarray(values, dtype=dtype)
+        self.blobs[name] = {"offset": self.offset, "dtype": array.dtype.str,
+                            "shape": list(array.shape)}
+        self.arrays.append((self.offset, array))
+        self.offset = self.aligned(self.offset + array.nbytes)
+        return name
+
+    def column(self, name, values):
+        if all(type(v) is int for v in values):
+            return {"blob": self.array(name, values)}
+        return {"json": [encode(v) for v in values]}
+
+    def write(self, path, manifest):
+        manifest["blobs"] = self.blobs
+        text = json.dumps(manifest).encode("utf8")
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, self.offset,
+                                len(text)))
+            for offset, array in self.arrays:
+                f.seek(offset)
+                f.write(array.tobytes())
+            f.seek(self.offset)
+            f.write(text)
+
+
+def instance_values(component):
+    values = dict(vars(component))
+    values.pop("entity", None)
+    values.pop("bound", None)
+    return values
+
+
+def save(path):
+    """
+    Write the live game to <path>
+    """
+    w = SnapshotWriter()
+    manifest = {"engine": {"seed": Engine.seed},
+                "singletons": {"Player": Player.active,
+                               "Camera": Camera.active}}
+
+    manifest["entity"] = {
+        "num_entities": Entity.num_entities,
+        "generations": w.array("entity/generations", Entity.generations),
+        "free": w.array("entity/free", list(Entity.free))}
+
+    version, internal, gauss_next = random.getstate()
+    manifest["rng"] = {"version": version, "gauss_next": gauss_next,
+                       "state": w.array("rng/state", internal, "<u4")}
+
+    components = manifest["components"] = {}
+    for cc in get_all_children(Component):
+        name = cc.__name__
+        prefix = "components/{}/".format(name)
+        if cc.store is not None:
+            store = cc.store
+            components[name] = {
+                "store": True,
+                "entities": w.array(prefix + "entities", store.entities()),
+                # rows get shuffled by removals; keep the table's own order
+                "table": w.array(prefix + "table", list(cc.table)),
+                "columns": {f: {"blob": w.array(prefix + f, store.column(f))}
+                            for f in cc.fields}}
+            continue
+        entities = list(cc.table)
+        rows = [instance_values(cc.table[e]) for e in entities]
+        keys = sorted(set().union(*rows)) if rows else []
+        components[name] = {
+            "store": False,
+            "entities": w.array(prefix + "entities", entities),
+            "columns": {k: w.column(prefix + k, [r.get(k) for r in rows])
+                        for k in keys}}
+
+    events = manifest["events"] = {}
+    for ec in get_all_children(Event):
+        if not ec.queue:
+            continue
+        prefix = "events/{}/".format(ec.__name__)
+        queued = list(ec.queue)
+        events[ec.__name__] = {
+            "count": len(queued),
+            "columns": {s: w.column(prefix + s, [getattr(e, s) for e in queued])
+                        for s in ec.__slots__}}
+
+    terrain = manifest["terrain"] = {}
+    for z, grid in Terrain.levels.items():
+        prefix = "terrain/{}/".format(z)
+        wall_hp = sorted((x, y, hp) for (x, y), hp in grid.wall_hp.items())
+        terrain[str(z)] = {
+            "tiles": w.array(prefix + "tiles", grid.tiles, "u1"),
+            "wall_hp": w.array(prefix + "wall_hp",
+                               numpy.array(wall_hp, dtype=numpy.int64)
+                               .reshape(-1, 3)),
+            "version": grid.version}
+
+    manifest["dungeon"] = {"seeds": Dungeon.seeds,
+                           "levels": sorted(Dungeon.levels),
+                           "lazy": Dungeon.lazy}
+    manifest["activity"] = sorted(Activity.level_turns.items())
+
+    heap = Scheduler.heap
+    manifest["scheduler"] = {
+        "now": Scheduler.now,
+        "seq": Scheduler.seq,
+        "heap": {"time": w.array("scheduler/time", [e[0] for e in heap]),
+                 "seq": w.array("scheduler/seq", [e[1] for e in heap]),
+                 "entity": w.array("scheduler/entity", [e[2] for e in heap]),
+                 "kind": [e[3] for e in heap]},
+        "current": [[e, kind, seq]
+                    for (e, kind), seq in Scheduler.current.items()]}
+
+    # queries are rebuilt from the tables, but the scheduler's record of
+    # who joined since it last looked has to be kept
+    manifest["arrivals"] = {str(i): query.arrivals
+                            for i, query in enumerate(Query.registry)
+                            if query.arrivals is not None}
+    manifest["spatial_version"] = SpatialIndex.version
+
+    w.write(path, manifest)
+
+
+class Snapshot(object):
+    """
+    A snapshot file, read lazily
+    With mmap=True (the default) blobs are views into a read-only memory
+    map of the file, so only what is looked at is ever read in
+    """
+    def __init__(self, path, mmap=True):
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise SnapshotError("{} is too short".format(path))
+            magic, version, _, offset, length = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise SnapshotError("{} is not a snapshot".format(path))
+            if version != FORMAT_VERSION:
+                raise SnapshotError("{} is snapshot format {}, not {}"
+                                    .format(path, version, FORMAT_VERSION))
+            f.seek(offset)
+            self.manifest = json.loads(f.read(length).decode("utf8"))
+        self.path = path
+        if mmap:
+            self.data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+        else:
+            self.data = numpy.fromfile(path, dtype=numpy.uint8)
+
+    def array(self, name):
+        blob = self.manifest["blobs"][name]
+        dtype = numpy.dtype(blob["dtype"])
+        count = int(numpy.prod(blob["shape"]))
+        start = blob["offset"]
+        return (self.data[start:start + count * dtype.itemsize]
+                .view(dtype).reshape(blob["shape"]))
+
+    def column(self, spec):
+        if "blob" in spec:
+            return self.array(spec["blob"])
+        return [decode(v) for v in spec["json"]]
+
+    def components(self):
+        return sorted(self.manifest["components"])
+
+    def component(self, name):
+        """
+        Get {"entities": ..., field: ...} for one component class
+        """
+        entry = self.manifest["components"][name]
+        columns = {f: self.column(spec)
+                   for f, spec in entry["columns"].items()}
+        columns["entities"] = self.array(entry["entities"])
+        return columns
+
+    def terrain(self, z):
+        return self.array(self.manifest["terrain"][str(z)]["tiles"])
+
+
+def load(path):
+    """
+    Replace the live game with the one saved in <path>
+    The engine must have been initialized (for its event handlers,
+    scheduler registrations, renderer and input), but what game it was
+    playing doesn't matter
+    """
+    restore(Snapshot(path, mmap=False))
+
+
+def restore(snapshot):
+    m = snapshot.manifest
+
+    Entity.num_entities = m["entity"]["num_entities"]
+    Entity.generations = snapshot.array(m["entity"]["generations"]).tolist()
+    Entity.free = deque(snapshot.array(m["entity"]["free"]).tolist())
+
+    by_name = {cc.__name__: cc for cc in get_all_children(Component)}
+    for cc in by_name.values():
+        cc.initialize()
+    for name, entry in m["components"].items():
+        cc = by_name[name]
+        entities = snapshot.array(entry["entities"])
+        columns = {f: snapshot.column(spec)
+                   for f, spec in entry["columns"].items()}
+        if cc.store is not None:
+            cc.store.fill(entities, columns)
+            for e in snapshot.array(entry["table"]).tolist():
+                component = cc.__new__(cc)
+                component.entity = e
+                component.bound = cc.store
+                cc.table[e] = component
+            continue
+        values = {f: (c.tolist() if isinstance(c, numpy.ndarray) else c)
+                  for f, c in columns.items()}
+        for i, e in enumerate(entities.tolist()):
+            component = cc.__new__(cc)
+            for f, column in values.items():
+                vars(component)[f] = column[i]
+            cc.table[e] = component
+
+    for ec in get_all_children(Event):
+        ec.initialize()
+    for name, entry in m["events"].items():
+        ec = next(ec for ec in get_all_children(Event) if ec.__name__ == name)
+        columns = {s: snapshot.column(spec)
+                   for s, spec in entry["columns"].items()}
+        for i in range(entry["count"]):
+            event = ec.__new__(ec)
+            for s, column in columns.items():
+                value = column[i]
+                setattr(event, s, int(value)
+                        if isinstance(value, numpy.integer) else value)
+            ec.add(event)
+
+    for i, query in enumerate(Query.registry):
+        query.refresh()
+        query.arrivals = m["arrivals"].get(str(i))
+
+    Player.active = m["singletons"]["Player"]
+    Camera.active = m["singletons"]["Camera"]
+
+    Terrain.initialize()
+    for z, level in m["terrain"].items():
+        grid = TileGrid(numpy.array(snapshot.array(level["tiles"])))
+        for x, y, hp in snapshot.array(level["wall_hp"]).tolist():
+            grid.wall_hp[x, y] = hp
+        grid.version = level["version"]
+        Terrain.add_level(int(z), grid)
+    Dungeon.seeds = m["dungeon"]["seeds"]
+    Dungeon.levels = {z: Terrain.level(z) for z in m["dungeon"]["levels"]}
+    Dungeon.lazy = m["dungeon"]["lazy"]
+
+    SpatialIndex.initialize()
+    for e in Location.table:
+        SpatialIndex.sync(e)
+    SpatialIndex.version = m["spatial_version"]
+
+    FlowField.initialize()
+    PathFinder.initialize()
+    FOV.initialize()
+    NearestEnemies.initialize()
+    Activity.initialize()
+    Activity.level_turns = {z: n for z, n in m["activity"]}
+
+    heap = m["scheduler"]["heap"]
+    Scheduler.now = m["scheduler"]["now"]
+    Scheduler.seq = m["scheduler"]["seq"]
+    Scheduler.heap = list(zip(snapshot.array(heap["time"]).tolist(),
+                              snapshot.array(heap["seq"]).tolist(),
+                              snapshot.array(heap["entity"]).tolist(),
+                              heap["kind"]))
+    Scheduler.current = {(e, kind): seq
+                         for e, kind, seq in m["scheduler"]["current"]}
+
+    version, gauss_next = m["rng"]["version"], m["rng"]["gauss_next"]
+    random.setstate((version,
+                     tuple(snapshot.array(m["rng"]["state"]).tolist()),
+                     gauss_next))
+    Engine.seed = m["engine"]["seed"]
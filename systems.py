@@ -8,59 +8,112 @@ Example: when a thing with Collideable overlaps something else with
          caused it,
          and fire off a Damage event
 """
-import curses
 import logging
+import random
 from assemblage import *
 from constants import *
 from components import *
 from events import *
 from mapgen import *
+from terrain import *
+from pathfinding import *
+from fov import *
+from scheduler import *
 from random import randint
 
 
+# Queries are registered once and kept up to date as components come and go
+actors = Query(Location, Depth, Faction, optional=(NPC, Player))
+npcs = Query(NPC, Location, Depth)
+awake_npcs = Query(NPC, Location, Depth, without=(Asleep,))
+up_stairs = Query(Ascender, Location, Depth)
+down_stairs = Query(Descender, Location, Depth)
+time_holders = Query(TIME, Depth, without=(Asleep,))
+timers = Query(Timer)
+rendered = Query(Depth, RenderData, Location)
+props = Query(Prop, Location, Depth, RenderData)
+
+
 def my_log(log_str):
     fire(Log(log_str))
     logging.info(log_str)
 
 
-def generate_map(depth):
-    the_map = double_cellular_automata(wall_percentage=45,
-                                       smooth_iters=2, smooth_threshold=5)
+def generate_map(depth, vectorized=True):
+    if vectorized and numpy is not None:
+        the_map = grid_to_map(double_cellular_automata_grid(
+            wall_percentage=45, smooth_iters=2, smooth_threshold=5))
+    else:
+        the_map = double_cellular_automata(wall_percentage=45,
+                                           smooth_iters=2, smooth_threshold=5)
     add_stairs(the_map, depth)
     return the_map
 
 
+def level_seeds(master_seed, num_levels):
+    """
+    Derive one seed per level from the master seed
+    """
+    rng = random.Random(master_seed)
+    return [rng.randrange(2**32) for _ in range(num_levels)]
+
+
+def generate_level(depth, level_seed):
+    """
+    generate_map for one level, seeded on its own so it comes out the same
+    whichever process runs it
+    """
+    random.seed(level_seed)
+    return generate_map(depth)
+
+
+def generate_dungeon(num_levels, master_seed, workers=1):
+    """
+    Generate the character maps for every level
+    With workers > 1 the levels are spread over a process pool; the maps
+    only depend on master_seed, not on how many workers there are
+    """
+    seeds = level_seeds(master_seed, num_levels)
+    if workers <= 1:
+        return [generate_level(l, s) for l, s in zip(range(num_levels), seeds)]
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(generate_level, range(num_levels), seeds))
+
+
 def actualize_map(the_map, depth):
-    create_real_tiles(the_map, depth)
-    create_adjacencies(the_map)
-    return the_map
+    return create_tile_grid(the_map, depth)
 
 
-def spawn(dungeon, depth, assemblage_with_location):
+def spawn(depth, assemblage_with_location):
     initial_x = randint(0, MAP_WIDTH - 1)
     initial_y = randint(0, MAP_HEIGHT - 1)
-    while Collideable.has_component(dungeon[depth][initial_x][initial_y]):
+    while not Terrain.walkable(depth, initial_x, initial_y):
         initial_x = randint(0, MAP_WIDTH - 1)
         initial_y = randint(0, MAP_HEIGHT - 1)
 
     assemblage_with_location(x=initial_x, y=initial_y, z=depth)
 
 
-def all_in_radius(entity, radius):
+def all_in_radius(entity, radius, *component_classes):
+    """
+    Get the actors (NPCs and players) on entity's level that are less than
+    <radius> away from it, optionally only those that also have all of
+    <component_classes>
+    """
     entity_location = Location.get_component(entity)
     entity_depth = Depth.get_component(entity)
 
     if entity_location is None or entity_depth is None:
         return
 
-    in_radius = []
-    for maybe_entity in Component.entities_with(Location, Depth):
-        if entity == maybe_entity:
-            continue
-        if Depth.same_level(Depth.get_component(maybe_entity), entity_depth):
-            if Location.distance2(Location.get_component(maybe_entity), entity_location) < radius **2:
-                in_radius.append(maybe_entity)
-    return in_radius
+    return [e for e in SpatialIndex.in_radius(entity_depth.z,
+                                              entity_location.x,
+                                              entity_location.y, radius)
+            if e != entity
+            if NPC.has_component(e) or Player.has_component(e)
+            if all(c.has_component(e) for c in component_classes)]
 
 
 def get_nearest_entity(entity):
@@ -70,12 +123,11 @@ def get_nearest_entity(entity):
     if entity_location is None or entity_depth is None:
         return None
 
-    entities = Component.entities_with(Location, NPC) + Component.entities_with(Location, Player)
-    locations = Location.components(entities)
-    depths = Depth.components(entities)
     min_ent = None
     min_dist = inf
-    for cur_entity, location, depth in zip(entities, locations, depths):
+    for cur_entity, location, depth, _, npc, player in actors:
+        if npc is None and player is None:
+            continue
         if cur_entity == entity:
             continue
         if not Depth.same_level(entity_depth, depth):
@@ -90,54 +142,126 @@ def get_nearest_entity(entity):
 
 def get_nearest_enemy(entity):
     from math import inf
-    entity_location = Location.get_component(entity)
     entity_depth = Depth.get_component(entity)
-    entity_faction = Faction.get_component(entity)
-    if entity_location is None or entity_depth is None:
-
+    if Location.get_component(entity) is None or entity_depth is None:
         return None
 
-    entities = Component.entities_with(Location, NPC) + Component.entities_with(Location, Player)
-    min_ent = None
-    min_dist = inf
-    for cur_entity in entities:
-        location = Location.get_component(cur_entity)
-        depth = Depth.get_component(cur_entity)
-        faction = Faction.get_component(cur_entity)
-
-        if faction.value == entity_faction.value:
-            continue
-        if cur_entity == entity:
-            continue
-        if not Depth.same_level(entity_depth, depth):
-            continue
-
-        dist2 = Location.distance2(entity_location, location)
-        if dist2 < min_dist:
-            min_dist = dist2
-            min_ent = cur_entity
-
-    return min_ent, min_dist
-
-
-def populate_dungeon(dungeon, depth):
+    return NearestEnemies.get(entity_depth.z).get(entity, (None, inf))
+
+
+class NearestEnemies(object):
+    """
+    For every NPC and player on a level, the nearest actor of another
+    faction on that level, worked out for all of them in one pass
+    A level's result is reused until something moves or the set of actors
+    changes, so every NPC (and the player's z) in a turn shares it
+    """
+    @staticmethod
+    def initialize():
+        NearestEnemies.levels = {}
+
+    @staticmethod
+    def get(z):
+        """
+        Get {entity: (nearest enemy, square distance)} for level z, with
+        (None, inf) for actors with no enemies on the level
+        """
+        key = (SpatialIndex.version, actors.version)
+        cached = NearestEnemies.levels.get(z, None)
+        if cached is None or cached[0] != key:
+            cached = (key, NearestEnemies.compute(z))
+            NearestEnemies.levels[z] = cached
+        return cached[1]
+
+    @staticmethod
+    def compute(z):
+        from math import inf
+        entities = [e for e in SpatialIndex.on_level(z)
+                    if e in actors
+                    if NPC.has_component(e) or Player.has_component(e)]
+        nearest = {}
+        if entities:
+            locations = Location.components(entities)
+            xs = numpy.array([l.x for l in locations])
+            ys = numpy.array([l.y for l in locations])
+            factions = numpy.array([f.value
+                                    for f in Faction.components(entities)])
+
+            dist2 = ((xs[:, None] - xs[None, :]) ** 2 +
+                     (ys[:, None] - ys[None, :]) ** 2).astype(float)
+            # allies (and yourself) are never the nearest enemy
+            dist2[factions[:, None] == factions[None, :]] = inf
+            closest = dist2.argmin(axis=1)
+            for i, entity in enumerate(entities):
+                d = dist2[i, closest[i]]
+                if d == inf:
+                    nearest[entity] = (None, inf)
+                else:
+                    nearest[entity] = (entities[closest[i]], int(d))
+        return nearest
+
+
+def populate_dungeon(depth):
     for floor in range(depth + 1):
-        if floor == DUNGEON_TOP:
-            spawn(dungeon, floor, Assemblage.Player)
-        for _ in range(5):
-            spawn(dungeon, floor, Assemblage.Zombie)
-        if randint(0, 99) < 10:
-            spawn(dungeon, floor, Assemblage.Wight)
-
-        if floor == DUNGEON_DEPTH:
-            spawn(dungeon, floor, Assemblage.Objective)
+        populate_level(floor)
+
+
+def populate_level(floor):
+    if floor == DUNGEON_TOP:
+        spawn(floor, Assemblage.Player)
+    for _ in range(5):
+        spawn(floor, Assemblage.Zombie)
+    if randint(0, 99) < 10:
+        spawn(floor, Assemblage.Wight)
+
+    if floor == DUNGEON_DEPTH:
+        spawn(floor, Assemblage.Objective)
+
+
+class Dungeon(object):
+    """
+    Keeps track of which levels have been turned into entities
+    In lazy mode only the top level exists at first; every other level is
+    generated, actualized, linked and populated by ensure_level the first
+    time something descends into it
+    """
+    @staticmethod
+    def initialize(master_seed, lazy=False):
+        Dungeon.seeds = level_seeds(master_seed, DUNGEON_DEPTH + 1)
+        Dungeon.levels = {}
+        Dungeon.lazy = lazy
+
+    @staticmethod
+    def add_level(the_map, depth):
+        Dungeon.levels[depth] = actualize_map(the_map, depth)
+
+    @staticmethod
+    def ensure_level(depth):
+        """
+        Bring level <depth> into existence if it isn't already
+        """
+        if depth in Dungeon.levels or not DUNGEON_TOP <= depth <= DUNGEON_DEPTH:
+            return
+
+        # generating reseeds random; don't let that disturb the game's stream
+        state = random.getstate()
+        the_map = generate_level(depth, Dungeon.seeds[depth])
+        random.setstate(state)
+
+        Dungeon.add_level(the_map, depth)
+        link_stairs()
+        populate_level(depth)
+
+        # built up front, these NPCs would have been asleep since the first
+        # turn; backdate their sleep so waking charges the decay they missed
+        for entity in sorted(SpatialIndex.levels.get(depth, ())):
+            if NPC.has_component(entity) and not Asleep.has_component(entity):
+                Asleep.add_to(entity, decay_turns=0)
 
 
 def link_stairs():
-    up_stairs = Component.entities_with(Ascender, Location, Depth)
-    down_stairs = Component.entities_with(Descender, Location, Depth)
-
-    all_pairs = [(up, down) for up in up_stairs for down in down_stairs]
+    all_pairs = [(up, down) for up in up_stairs.entities()
+                 for down in down_stairs.entities()]
 
     for stair_pair in all_pairs:
         up_depth = Depth.get_component(stair_pair[0])
@@ -193,8 +317,21 @@ def fire_player_action(ipt):
             fire(ActorChangeLevel(player_depth.z - 1, player))
 
         if ipt == 'x':
-            for entity in all_in_radius(player, FOV_RADIUS):
-                fire(TIMEPulse(player, entity))
+            seen = FOV.visible(player_depth.z, player_location.x,
+                               player_location.y, FOV_RADIUS)
+            for entity in all_in_radius(player, FOV_RADIUS, HP):
+                location = Location.get_component(entity)
+                if seen[location.x, location.y]:
+                    fire(TIMEPulse(player, entity))
+            # walls are terrain, but the pulse still hits every one in
+            # view, at the same TIME cost as hitting an actor
+            atk = ATK.get_component(player).value
+            walls = seen & (Terrain.level(player_depth.z).tiles == TILE_WALL)
+            for wall_x, wall_y in numpy.argwhere(walls).tolist():
+                fire(TileDamage(atk, wall_x, wall_y, player_depth.z))
+                fire(TimeDamage(atk, player))
+            Activity.noise(player_depth.z, player_location.x,
+                           player_location.y, NOISE_RADIUS)
 
         if ipt == 'z':
             fire(TIMESiphon(player, get_nearest_enemy(player)[0]))
@@ -218,25 +355,36 @@ def fire_player_action(ipt):
         fire(Quit())
 
 
-def fire_npc_actions():
-    npcs = Component.entities_with(NPC, Location)
-
-    for npc in npcs:
-        loc = Location.get_component(npc)
-        depth = Depth.get_component(npc)
-        if abs(depth.z - Depth.get_component(Player.active).z) == 0:
-            near = all_in_radius(npc, FOV_RADIUS)
-            nearest = get_nearest_enemy(npc)
-            nloc = Location.get_component(nearest[0])
-            if (nearest[0] in near and
-                nearest != npc and
-                    nloc is not None):
+def npc_act(npc):
+    """
+    Scheduler handler for awake NPCs: fire this NPC's next move, and
+    return the ticks until it acts again
+    """
+    loc = Location.get_component(npc)
+    depth = Depth.get_component(npc)
+    if abs(depth.z - Depth.get_component(Player.active).z) == 0:
+        nearest = get_nearest_enemy(npc)
+        nloc = Location.get_component(nearest[0])
+        if (nloc is not None and
+                FOV.can_see(depth.z, loc.x, loc.y, FOV_RADIUS,
+                            nloc.x, nloc.y)):
+            if nearest[0] == Player.active:
+                # everyone chasing the player shares one flow field
+                step = FlowField.step(depth.z, nloc.x, nloc.y,
+                                      loc.x, loc.y)
+            else:
+                step = PathFinder.next_step(depth.z, (loc.x, loc.y),
+                                            (nloc.x, nloc.y))
+            if step is not None:
+                x, y = step
+            else:
                 dir = Location.direction(loc, nloc)
                 x, y = loc.x + dir[0], loc.y + dir[1]
-                fire(ActorMoved(x, y, npc))
-            else:
-                x, y = loc.x + randint(-1, 1), loc.y + randint(-1, 1)
-                fire(ActorMoved(x, y, npc))
+            fire(ActorMoved(x, y, npc))
+        else:
+            x, y = loc.x + randint(-1, 1), loc.y + randint(-1, 1)
+            fire(ActorMoved(x, y, npc))
+    return Scheduler.delay(npc)
 
 
 def update_camera():
@@ -264,12 +412,7 @@ def update_camera():
         camera_loc.y = MAP_HEIGHT - 1 - SCREEN_HEIGHT // 2
 
 
-def update_physics():
-    action = ActorMoved.pop()
-
-    if action is None:
-        return
-
+def update_physics(action):
     # Execute the move.
     # This event has execute() and undo()
     # just in case the actor bumps something
@@ -285,39 +428,149 @@ def update_physics():
     actor_depth = Depth.get_component(entity=actor)
 
     fire(Refresh(actor))
+
+    # Walls are terrain: bumping one undoes the move and hits the wall
+    if not Terrain.walkable(actor_depth.z, actor_location.x, actor_location.y):
+        wall_x, wall_y = actor_location.x, actor_location.y
+        action.undo()
+        atk = ATK.get_component(actor)
+        if atk is not None:
+            fire(TileDamage(atk.value, wall_x, wall_y, actor_depth.z))
+        return
+
     # Get the next entity that collides with the entity that just moved;
     # We may need to undo our move
     # next(..., None) makes it return None if we hit StopIteration
-    collider = next((e for e in Component.entities_with(Location, Collideable)
+    collider = next((e for e in SpatialIndex.at(actor_depth.z,
+                                                actor_location.x,
+                                                actor_location.y)
                      if e != actor
-                     if Location.intersects(actor_location,
-                                            Location.get_component(entity=e))
-                    if Depth.same_level(actor_depth,
-                                        Depth.get_component(entity=e))),
+                     if Collideable.has_component(e)),
                     None)
 
     if collider is not None:
-        fire(Collision(actor, collider, action))
-
+        fire(Collision(actor, collider))
+
+
+def blockers_at(z, x, y, entity):
+    return [e for e in SpatialIndex.at(z, x, y)
+            if e != entity
+            if Collideable.has_component(e)
+            if Collideable.get_component(e).blocks]
+
+
+def resolve_moves_batch(moves):
+    """
+    Batch version of update_physics: resolve every move of a sweep at once
+    Only an entity's latest move counts. Movers are taken player first,
+    then by entity id, and where several want the same cell the first of
+    them is the only one that may enter it. A move into a cell held by a
+    blocker goes through only if the blocker itself moves away; blockers
+    that stay, and cycles of movers waiting on each other, block it
+    Blocked moves never happen: the mover stays put and collides with
+    whatever blocked it (the claimant of the cell if that got in, or else
+    whatever is standing there)
+    """
+    wanted = {}
+    for m in moves:
+        wanted[m.entity] = (m.x, m.y)
+    order = sorted(wanted, key=lambda e: (e != Player.active, e))
+
+    # drop the moves that can't happen whatever the others do
+    plans = {}
+    claims = {}
+    for actor in order:
+        actor_location = Location.get_component(actor)
+        actor_depth = Depth.get_component(actor)
+        if actor_location is None or actor_depth is None:
+            continue
+        fire(Refresh(actor))
+
+        z = actor_depth.z
+        x, y = wanted[actor]
+        if (x, y) == (actor_location.x, actor_location.y):
+            pass
+        elif not in_bounds(x, y):
+            pass
+        elif not Terrain.walkable(z, x, y):
+            atk = ATK.get_component(actor)
+            if atk is not None:
+                fire(TileDamage(atk.value, x, y, z))
+        else:
+            plans[actor] = (z, x, y)
+            claims.setdefault((z, x, y), actor)
+            continue
+        # staying put still counts as a move for undo purposes
+        actor_location.last_x = actor_location.x
+        actor_location.last_y = actor_location.y
+
+    # follow each chain of movers waiting on the one ahead of them; the
+    # whole chain goes through if its head reaches a free cell
+    moved = {}
+    blocked_by = {}
+    for actor in plans:
+        chain = []
+        entity = actor
+        while entity not in moved:
+            moved[entity] = None
+            chain.append(entity)
+            if claims[plans[entity]] != entity:
+                result = False
+                break
+            blockers = blockers_at(*plans[entity], entity)
+            if not blockers:
+                result = True
+                break
+            blocked_by[entity] = blockers[0]
+            if len(blockers) > 1 or blockers[0] not in plans:
+                result = False
+                break
+            entity = blockers[0]
+        else:
+            # None is a cycle back into this chain
+            result = bool(moved[entity])
+        for entity in chain:
+            moved[entity] = result
+
+    for actor in plans:
+        location = Location.get_component(actor)
+        location.last_x = location.x
+        location.last_y = location.y
+        if moved[actor]:
+            location.x, location.y = plans[actor][1:]
+            SpatialIndex.sync(actor)
+
+    for actor in plans:
+        if moved[actor]:
+            collider = next((e for e in SpatialIndex.at(*plans[actor])
+                             if e != actor
+                             if Collideable.has_component(e)), None)
+        else:
+            claimant = claims[plans[actor]]
+            if claimant != actor and moved[claimant]:
+                collider = claimant
+            elif claimant != actor:
+                # the claimant was blocked too: hit whatever blocked it
+                blockers = blockers_at(*plans[actor], actor)
+                collider = blockers[0] if blockers else None
+            else:
+                collider = blocked_by.get(actor, None)
+        if collider is not None and Collideable.has_component(collider):
+            fire(Collision(actor, collider))
 
-def update_depth():
-    depth_change = ActorChangeLevel.pop()
 
-    if depth_change is None:
-        return
-    
+def update_depth(depth_change):
     actor = depth_change.entity
     actor_depth = Depth.get_component(entity=actor)
 
     direction = depth_change.z - actor_depth.z
-    up_stairs = Component.entities_with(Ascender, Location)
-    down_stairs = Component.entities_with(Descender, Location)
+    actor_location = Location.get_component(actor)
+    here = SpatialIndex.at(actor_depth.z, actor_location.x, actor_location.y)
 
     if direction < 0:
-        for up_stair in up_stairs:
-            if (Location.intersects(Location.get_component(up_stair),
-                                    Location.get_component(actor)) and
-                    (Depth.same_level(actor_depth, Depth.get_component(up_stair)))):
+        for up_stair in here:
+            ascender = Ascender.get_component(up_stair)
+            if ascender is not None:
                 # We're on the top floor?
                 if actor == Player.active and actor_depth.z == DUNGEON_TOP:
                     for entity in Inventory.get_component(actor).slots.values():
@@ -327,60 +580,138 @@ def update_depth():
                     fire(Quit())
                     break
 
-                up_stair_connector = Ascender.get_component(up_stair).up
+                up_stair_connector = ascender.up
+                if not Entity.alive(up_stair_connector):
+                    break
                 up_stair_connector_loc = Location.get_component(up_stair_connector)
                 depth_change.execute()
                 fire(Ascent())
                 fire(ActorMoved(up_stair_connector_loc.x,
                                 up_stair_connector_loc.y,
                                 actor))
+                break
 
     if direction > 0:
-        for down_stair in down_stairs:
-            if (Location.intersects(Location.get_component(down_stair),
-                                    Location.get_component(actor)) and
-                    (Depth.same_level(actor_depth, Depth.get_component(down_stair)))) :
-                down_stair_connector = Descender.get_component(down_stair).down
+        for down_stair in here:
+            descender = Descender.get_component(down_stair)
+            if descender is not None:
+                if descender.down is None and Dungeon.lazy:
+                    Dungeon.ensure_level(actor_depth.z + 1)
+                down_stair_connector = descender.down
+                if not Entity.alive(down_stair_connector):
+                    break
                 down_stair_connector_loc = Location.get_component(down_stair_connector)
                 depth_change.execute()
                 fire(Descent())
                 fire(ActorMoved(down_stair_connector_loc.x,
                                 down_stair_connector_loc.y,
                                 actor))
+                break
 
 
 def update_TIME():
-    timed = Component.entities_with(TIME)
-    for entity in timed:
-        time = TIME.get_component(entity)
-        depth = Depth.get_component(entity)
-        if abs(depth.z - Depth.get_component(Player.active).z) <= 1:
+    player_z = Depth.get_component(Player.active).z
+    Activity.tick(player_z)
+
+    if TIME.store is not None and Depth.store is not None:
+        entities = numpy.array(time_holders.entities(), dtype=numpy.int64)
+        near = abs(Depth.store.gather(entities, "z") - player_z) <= 1
+        entities = entities[near]
+        rows = TIME.store.rows(entities)
+        values = TIME.store.column("value")
+        values[rows] -= TIME.store.column("decay_rate")[rows]
+        for entity in entities[values[rows] <= 0].tolist():
+            fire(Death(entity, "decay"))
+        return
+
+    for entity, time, depth in time_holders:
+        if abs(depth.z - player_z) <= 1:
             time.value -= time.decay_rate
             if time.value <= 0:
-                fire(Death(entity))
+                fire(Death(entity, "decay"))
+
+
+class Activity(object):
+    """
+    Simulation level of detail for NPCs
+    NPCs on another level than the player, or further than WAKE_RADIUS
+    from them, are put to sleep (given Asleep) and drop out of the awake
+    queries that fire_npc_actions and update_TIME walk. They wake up when
+    the player comes near, when they hear the x pulse, or when they take
+    damage, and are charged then for the TIME decay they slept through
+    level_turns counts, per level, the turns in which TIME decayed there
+    (the player being within one level of it)
+    """
+    @staticmethod
+    def initialize():
+        Activity.level_turns = {}
+
+    @staticmethod
+    def tick(player_z):
+        for z in range(player_z - 1, player_z + 2):
+            Activity.level_turns[z] = Activity.level_turns.get(z, 0) + 1
+
+    @staticmethod
+    def sleep(entity):
+        depth = Depth.get_component(entity)
+        Asleep.add_to(entity, decay_turns=Activity.level_turns.get(depth.z, 0))
+
+    @staticmethod
+    def wake(entity):
+        asleep = Asleep.get_component(entity)
+        if asleep is None:
+            return
+        Asleep.rm_from(entity)
 
+        time = TIME.get_component(entity)
+        depth = Depth.get_component(entity)
+        if time is not None and depth is not None:
+            missed = Activity.level_turns.get(depth.z, 0) - asleep.decay_turns
+            if missed > 0 and time.decay_rate:
+                time.value -= time.decay_rate * missed
+                if time.value <= 0:
+                    fire(Death(entity, "decay"))
+
+    @staticmethod
+    def noise(z, x, y, radius):
+        """
+        Wake every sleeper within <radius> of (x, y) on level z
+        """
+        for entity in SpatialIndex.in_radius(z, x, y, radius):
+            Activity.wake(entity)
+
+
+def update_activity():
+    player_depth = Depth.get_component(Player.active)
+    player_loc = Location.get_component(Player.active)
 
-def update_timers():
-    timed = Component.entities_with(Timer)
+    for npc, _, loc, depth in awake_npcs:
+        if (depth.z != player_depth.z or
+                Location.distance2(loc, player_loc) >= WAKE_RADIUS ** 2):
+            Activity.sleep(npc)
 
-    for timed_one in timed:
-        timer = Timer.get_component(timed_one)
-        timer.time += 1
-        if timer.time == timer.max_time:
-            timer.time = 0
-            fire(Heal(timed_one))
+    Activity.noise(player_depth.z, player_loc.x, player_loc.y, WAKE_RADIUS)
 
-def resolve_action():
-    pickup_event = ActorPickup.pop()
 
-    if pickup_event is None:
-        return
+def timer_period(timed_one):
+    return Timer.get_component(timed_one).max_time * ACTION_TICKS
 
+
+def timer_fired(timed_one):
+    """
+    Scheduler handler for Timers
+    """
+    fire(Heal(timed_one))
+    return timer_period(timed_one)
+
+
+def resolve_action(pickup_event):
     actor = pickup_event.entity
+    actor_depth = Depth.get_component(actor)
 
-    all_here = (e for e in Component.entities_with(Carriable, Location)
-                if Location.get_component(e).x == pickup_event.x
-                if Location.get_component(e).y == pickup_event.y)
+    all_here = [e for e in SpatialIndex.at(actor_depth.z,
+                                           pickup_event.x, pickup_event.y)
+                if Carriable.has_component(e)]
 
     inv_slots = Inventory.get_component(actor).slots
 
@@ -394,31 +725,24 @@ def resolve_action():
                      sorted((k, v) for k, v in inv_slots.items()))
 
 
-def resolve_special():
-    time_pulse_event = TIMEPulse.pop()
-
-    while time_pulse_event is not None:
-        actor_time = TIME.get_component(time_pulse_event.actor)
-        actor_atk = ATK.get_component(time_pulse_event.actor)
-        target_health = HP.get_component(time_pulse_event.target)
+def resolve_special(time_pulse_event):
+    actor_atk = ATK.get_component(time_pulse_event.actor)
+    target_health = HP.get_component(time_pulse_event.target)
 
-        if target_health is None:
-            time_pulse_event = TIMEPulse.pop()
-            continue
-
-        fire(TimeDamage(actor_atk.value, time_pulse_event.actor))
-        fire(Damage(actor_atk.value, time_pulse_event.target))
-        time_pulse_event = TIMEPulse.pop()
+    if target_health is None:
+        return
 
+    fire(TimeDamage(actor_atk.value, time_pulse_event.actor))
+    fire(Damage(actor_atk.value, time_pulse_event.target))
 
-def update_collisions():
-    c = Collision.pop()
 
-    if c is None:
+def update_collisions(c):
+    # either side may have been destroyed since the collision was fired
+    if not (Entity.alive(c.initiator) and Entity.alive(c.receiver)):
         return
 
     if Collideable.get_component(c.receiver).blocks:
-        c.action.undo()
+        ActorMoved.revert(c.initiator)
 
     atk = ATK.get_component(c.initiator)
     if atk is not None:
@@ -426,74 +750,159 @@ def update_collisions():
         fire(TIMESiphon(c.initiator, c.receiver))
 
 
-def resolve_heals():
-    h = Heal.pop()
+def resolve_heals(h):
+    target_hp = HP.get_component(h.actor)
+    if target_hp is not None and target_hp.value < 10:
+        target_hp.value += 1
 
-    while h is not None:
-        target_hp = HP.get_component(h.actor)
-        if target_hp is not None and target_hp.value < 10:
-            target_hp.value += 1
-        h = Heal.pop()
 
+def resolve_damage(d):
+    Activity.wake(d.target)
+    target_hp = HP.get_component(d.target)
+    if target_hp is not None:
+        target_hp.value -= d.dmg
+        if target_hp.value <= 0:
+            fire(Death(d.target, "damage"))
 
-def resolve_damage():
-    d = Damage.pop()
 
-    while d is not None:
-        target_hp = HP.get_component(d.target)
-        if target_hp is not None:
-            target_hp.value -= d.dmg
-            if target_hp.value <= 0:
-                fire(Death(d.target))
-        d = Damage.pop()
+def resolve_time_damage(t):
+    Activity.wake(t.target)
+    target_time = TIME.get_component(t.target)
+    if target_time is not None:
+        target_time.value -= t.dmg
+        if target_time.value <= 0:
+            fire(Death(t.target, "time"))
 
-    t = TimeDamage.pop()
-    while t is not None:
-        target_time = TIME.get_component(t.target)
-        if target_time is not None:
-            target_time.value -= t.dmg
-            if target_time.value <= 0:
-                fire(Death(t.target))
-        t = TimeDamage.pop()
 
+def resolve_tile_damage(w):
+    if Terrain.damage_wall(w.z, w.x, w.y, w.dmg):
+        wall_death(w.x, w.y, w.z)
 
-def resolve_time_siphon():
-    siphon_event = TIMESiphon.pop()
 
-    while siphon_event is not None:
-        actor_atk = ATK.get_component(siphon_event.actor)
-        actor_time = TIME.get_component(siphon_event.actor)
-        target_time = TIME.get_component(siphon_event.target)
-        if target_time is not None and actor_atk is not None:
-            fire(TimeDamage(actor_atk.value, siphon_event.target))
-            fire(Damage(actor_atk.value - 1, siphon_event.actor))
+def resolve_time_siphon(siphon_event):
+    actor_atk = ATK.get_component(siphon_event.actor)
+    actor_time = TIME.get_component(siphon_event.actor)
+    target_time = TIME.get_component(siphon_event.target)
+    if target_time is not None and actor_atk is not None:
+        fire(TimeDamage(actor_atk.value, siphon_event.target))
+        fire(Damage(actor_atk.value - 1, siphon_event.actor))
 
-            actor_time.value += actor_atk.value
-        siphon_event = TIMESiphon.pop()
+        actor_time.value += actor_atk.value
 
 
-def resolve_death():
-    d = Death.pop()
+def resolve_death(d):
+    death_trigger = OnDeath.get_component(d.target)
+    if death_trigger is not None:
+        death_trigger.death_function(d.target)
 
-    while d is not None:
-        death_trigger = OnDeath.get_component(d.target)
-        if death_trigger is not None:
-            death_trigger.death_function(d.target)
-        d = Death.pop()
 
+def apply_hits(stat, targets, amounts, cause):
+    """
+    Take <amounts> off the <stat> of an array of targets in one step,
+    summing repeated targets, and fire Death (of <cause>) for every one of
+    them left at or below zero. Targets are woken first, as single hits
+    would wake them
+    """
+    targets = numpy.asarray(targets, dtype=numpy.int64)
+    if not len(targets):
+        return
+    unique, inverse = numpy.unique(targets, return_inverse=True)
+    totals = numpy.zeros(len(unique), dtype=numpy.int64)
+    numpy.add.at(totals, inverse, amounts)
+
+    for entity in unique.tolist():
+        if entity in Asleep.table:
+            Activity.wake(entity)
+
+    rows = stat.store.rows(unique)
+    hit = rows >= 0
+    rows = rows[hit]
+    values = stat.store.column("value")
+    values[rows] -= totals[hit]
+    for entity in unique[hit][values[rows] <= 0].tolist():
+        fire(Death(entity, cause))
 
-def resolve_level_change():
-    ascent_event = Ascent.pop()
-    descent_event = Descent.pop()
 
-    if not any([ascent_event, descent_event]):
+# Batch versions of the resolvers above: each takes a whole drained queue.
+# They need the columnar stat storage and fall back to the one-at-a-time
+# resolvers without it
+
+
+def resolve_heals_batch(heals):
+    if HP.store is None:
+        for h in heals:
+            resolve_heals(h)
         return
 
-    player_depth = Depth.get_component(Player.active)
-    depth_entities = Component.entities_with(Depth, RenderData, Location)
-    depth_components = Depth.components(depth_entities)
+    actors, counts = numpy.unique(
+        numpy.array([h.actor for h in heals], dtype=numpy.int64),
+        return_counts=True)
+    rows = HP.store.rows(actors)
+    present = rows >= 0
+    rows, counts = rows[present], counts[present]
+    values = HP.store.column("value")
+    hp = values[rows]
+    values[rows] = numpy.where(hp < 10, numpy.minimum(hp + counts, 10), hp)
+
+
+def resolve_damage_batch(damages):
+    if HP.store is None:
+        for d in damages:
+            resolve_damage(d)
+        return
+
+    apply_hits(HP, [d.target for d in damages], [d.dmg for d in damages],
+               "damage")
+
+
+def resolve_time_damage_batch(hits):
+    if TIME.store is None:
+        for t in hits:
+            resolve_time_damage(t)
+        return
+
+    apply_hits(TIME, [t.target for t in hits], [t.dmg for t in hits], "time")
+
+
+def resolve_special_batch(pulses):
+    if HP.store is None:
+        for p in pulses:
+            resolve_special(p)
+        return
+
+    # every pulse that lands costs the actor TIME and the target HP
+    actors = numpy.array([p.actor for p in pulses], dtype=numpy.int64)
+    targets = numpy.array([p.target for p in pulses], dtype=numpy.int64)
+    lands = HP.store.has(targets)
+    actors, targets = actors[lands], targets[lands]
+    atk = ATK.store.gather(actors, "value")
+    apply_hits(TIME, actors, atk, "time")
+    apply_hits(HP, targets, atk, "damage")
+
+
+def resolve_time_siphon_batch(siphons):
+    if TIME.store is None:
+        for s in siphons:
+            resolve_time_siphon(s)
+        return
 
-    for e, c in zip(depth_entities, depth_components):
+    # 'z' with no enemy around siphons from None
+    siphons = [s for s in siphons if s.target is not None]
+    actors = numpy.array([s.actor for s in siphons], dtype=numpy.int64)
+    targets = numpy.array([s.target for s in siphons], dtype=numpy.int64)
+    valid = (TIME.store.has(targets) & TIME.store.has(actors)
+             & ATK.store.has(actors))
+    actors, targets = actors[valid], targets[valid]
+    atk = ATK.store.gather(actors, "value")
+
+    numpy.add.at(TIME.store.column("value"), TIME.store.rows(actors), atk)
+    apply_hits(TIME, targets, atk, "time")
+    apply_hits(HP, actors, atk - 1, "damage")
+
+
+def resolve_level_change(level_change):
+    player_depth = Depth.get_component(Player.active)
+    for e, c, _, _ in rendered:
         if c.z == player_depth:
             fire(Refresh(e))
         else:
@@ -503,6 +912,9 @@ def resolve_level_change():
 
 
 def initialize_render():
+    # only the curses frontend draws through here, so a headless game
+    # never needs curses
+    import curses
     stdscr = curses.initscr()
     curses.noecho()
     curses.cbreak()
@@ -526,18 +938,27 @@ def initialize_render():
 def update_render(stdscr, pads, msg_log, stat_log):
     clear_event = ClearScreen.pop()
 
+    player_depth = Depth.get_component(entity=Player.active)
+
     if clear_event is not None:
         for pad in pads:
             pad.clear()
-
+        # the terrain lives on the back layer and is only redrawn in full
+        # when the screen is cleared
+        for x in range(MAP_WIDTH):
+            for y in range(MAP_HEIGHT):
+                pads[BACK].addch(y, x, Terrain.glyph(player_depth.z, x, y))
+
+    tile_change = TileChanged.pop()
+    while tile_change is not None:
+        if tile_change.z == player_depth.z:
+            pads[BACK].addch(tile_change.y, tile_change.x,
+                             Terrain.glyph(tile_change.z, tile_change.x,
+                                           tile_change.y))
+        tile_change = TileChanged.pop()
 
     # render props
-    player_depth = Depth.get_component(entity=Player.active)
-    props = Component.entities_with(Prop, Location, RenderData)
-    for p in props:
-        render = RenderData.get_component(entity=p)
-        location = Location.get_component(entity=p)
-        depth = Depth.get_component(entity=p)
+    for p, _, location, depth, render in props:
         if Depth.same_level(player_depth, depth):
             pads[render.last_layer].delch(location.y, location.x)
             pads[render.last_layer].insch(location.y, location.x, ' ')
@@ -553,7 +974,10 @@ def update_render(stdscr, pads, msg_log, stat_log):
         render = RenderData.get_component(entity=refreshee.entity)
         location = Location.get_component(entity=refreshee.entity)
         depth = Depth.get_component(entity=refreshee.entity)
-        if Depth.same_level(player_depth, depth):
+        if None in (render, location, depth):
+            # destroyed after the refresh was fired
+            pass
+        elif Depth.same_level(player_depth, depth):
             pads[render.last_layer].delch(location.last_y, location.last_x)
             pads[render.last_layer].insch(location.last_y, location.last_x, ' ')
             pads[render.layer].addch(location.y, location.x,
@@ -562,6 +986,19 @@ def update_render(stdscr, pads, msg_log, stat_log):
             render.last_layer = render.layer
         refreshee = Refresh.pop()
 
+    # NPCs are only drawn while the player can see them
+    player_loc = Location.get_component(entity=Player.active)
+    seen = FOV.visible(player_depth.z, player_loc.x, player_loc.y, FOV_RADIUS)
+    for npc, _, location, depth in npcs:
+        render = RenderData.get_component(entity=npc)
+        if render is None or not Depth.same_level(player_depth, depth):
+            continue
+        if seen[location.x, location.y]:
+            pads[render.layer].addch(location.y, location.x, render.glyph)
+        else:
+            pads[render.layer].delch(location.y, location.x)
+            pads[render.layer].insch(location.y, location.x, ' ')
+
     camera_entity = Camera.active
     camera_loc = Location.get_component(entity=camera_entity)
 
@@ -569,6 +1006,12 @@ def update_render(stdscr, pads, msg_log, stat_log):
     while Location.just_removed:
         entity, location = Location.just_removed.pop(0)
         render = RenderData.get_component(entity)
+        if render is None:
+            # destroyed entities lose their RenderData in the same turn
+            render = next((r for e, r in RenderData.just_removed
+                           if e == entity), None)
+            if render is None:
+                continue
         pads[render.last_layer].delch(location.last_y, location.last_x)
         pads[render.last_layer].insch(location.last_y, location.last_x, ' ')
 
@@ -602,6 +1045,7 @@ def update_render(stdscr, pads, msg_log, stat_log):
 
 
 def terminate_render(stdscr):
+    import curses
     stdscr.keypad(False)
     curses.curs_set(1)
     curses.nocbreak()
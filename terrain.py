@@ -0,0 +1,180 @@
+"""
+Terrain
+=======
+Static map tiles don't get to be entities: each level's terrain is a dense
+grid of tile types (see the TILE_ constants) with walkable and opaque masks
+kept alongside, plus a side table for the HP of walls that have been hit.
+Only actors, items and stairs are entities.
+"""
+import numpy
+from constants import *
+
+WALKABLE = numpy.array(TILE_WALKABLE, dtype=bool)
+OPAQUE = numpy.array(TILE_OPAQUE, dtype=bool)
+MAP_TILES = {".": TILE_FLOOR, "#": TILE_WALL,
+             ">": TILE_DOWN_STAIR, "<": TILE_UP_STAIR}
+# 8-way, in the same order the old per-tile neighbor lists were built
+NEIGHBOR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                    if not (dx == 0 and dy == 0)]
+
+
+class TileGrid(object):
+    """
+    The terrain of one level, indexed [x, y] like the maps in mapgen
+    version goes up every time a tile's walkability or opacity changes, so
+    the FOV and path caches kept off the grid can tell when they're stale
+    (a tile that only looks different, like a corpse, leaves them be)
+    Cells are also numbered x * height + y for the flat adjacency arrays
+    A grid a forked world shares is never written to: Terrain.writable()
+    swaps in a copy first
+    """
+    shared = False
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.width, self.height = tiles.shape
+        self.walkable = WALKABLE[tiles]
+        self.opaque = OPAQUE[tiles]
+        self.wall_hp = {}
+        self.version = 0
+        self.csr = None
+        self.csr_version = -1
+
+    @staticmethod
+    def from_map(the_map):
+        """
+        Build a grid from a map of #, ., > and <
+        """
+        return TileGrid(numpy.array([[MAP_TILES[c] for c in column]
+                                     for column in the_map],
+                                    dtype=numpy.uint8))
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def cell(self, x, y):
+        return x * self.height + y
+
+    def coords(self, cell):
+        return divmod(cell, self.height)
+
+    def neighbors(self, x, y):
+        """
+        Walkable cells next to (x, y), worked out from the grid on the fly
+        """
+        walkable = self.walkable
+        for dx, dy in NEIGHBOR_OFFSETS:
+            i, j = x + dx, y + dy
+            if 0 <= i < self.width and 0 <= j < self.height and walkable[i, j]:
+                yield i, j
+
+    def adjacency(self):
+        """
+        Walkable-to-walkable adjacency in compressed sparse row form
+        The neighbors of cell c are indices[indptr[c]:indptr[c + 1]]
+        Rebuilt on the first call after the terrain changes
+        """
+        if self.csr_version != self.version:
+            self.csr = self.build_adjacency()
+            self.csr_version = self.version
+        return self.csr
+
+    def build_adjacency(self):
+        width, height = self.width, self.height
+        cells = numpy.arange(width * height).reshape(width, height)
+        sources = []
+        targets = []
+        for dx, dy in NEIGHBOR_OFFSETS:
+            # the part of the grid whose (dx, dy) neighbor is in bounds
+            xs = slice(max(0, -dx), width - max(0, dx))
+            ys = slice(max(0, -dy), height - max(0, dy))
+            shifted_xs = slice(xs.start + dx, xs.stop + dx)
+            shifted_ys = slice(ys.start + dy, ys.stop + dy)
+            edge = self.walkable[xs, ys] & self.walkable[shifted_xs, shifted_ys]
+            sources.append(cells[xs, ys][edge])
+            targets.append(cells[shifted_xs, shifted_ys][edge])
+
+        sources = numpy.concatenate(sources)
+        targets = numpy.concatenate(targets)
+        order = numpy.argsort(sources, kind="stable")
+        indptr = numpy.zeros(width * height + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=width * height),
+                     out=indptr[1:])
+        return indptr, targets[order]
+
+    def copy(self):
+        twin = TileGrid.__new__(TileGrid)
+        vars(twin).update(vars(self))
+        twin.tiles = self.tiles.copy()
+        twin.walkable = self.walkable.copy()
+        twin.opaque = self.opaque.copy()
+        twin.wall_hp = dict(self.wall_hp)
+        twin.shared = False
+        return twin
+
+    def set_tile(self, x, y, tile):
+        self.tiles[x, y] = tile
+        self.wall_hp.pop((x, y), None)
+        if (self.walkable[x, y] != WALKABLE[tile] or
+                self.opaque[x, y] != OPAQUE[tile]):
+            self.walkable[x, y] = WALKABLE[tile]
+            self.opaque[x, y] = OPAQUE[tile]
+            self.version += 1
+
+
+class Terrain(object):
+    """
+    All the levels' TileGrids, by depth
+    """
+    @staticmethod
+    def initialize():
+        Terrain.levels = {}
+
+    @staticmethod
+    def add_level(depth, grid):
+        Terrain.levels[depth] = grid
+
+    @staticmethod
+    def level(depth):
+        return Terrain.levels.get(depth, None)
+
+    @staticmethod
+    def writable(depth):
+        """
+        The grid at <depth>, copied first if it's shared with a fork
+        """
+        grid = Terrain.levels[depth]
+        if grid.shared:
+            grid = Terrain.levels[depth] = grid.copy()
+        return grid
+
+    @staticmethod
+    def tile(z, x, y):
+        return Terrain.levels[z].tiles[x, y]
+
+    @staticmethod
+    def walkable(z, x, y):
+        grid = Terrain.levels.get(z, None)
+        return (grid is not None and in_bounds(x, y) and
+                bool(grid.walkable[x, y]))
+
+    @staticmethod
+    def neighbors(z, x, y):
+        return Terrain.levels[z].neighbors(x, y)
+
+    @staticmethod
+    def glyph(z, x, y):
+        return TILE_GLYPHS[Terrain.levels[z].tiles[x, y]]
+
+    @staticmethod
+    def damage_wall(z, x, y, dmg):
+        """
+        Knock <dmg> off the wall at (x, y)
+        Return whether that destroyed it
+        """
+        if Terrain.levels[z].tiles[x, y] != TILE_WALL:
+            return False
+        grid = Terrain.writable(z)
+        hp = grid.wall_hp.get((x, y), WALL_HP) - dmg
+        grid.wall_hp[(x, y)] = hp
+        return hp <= 0
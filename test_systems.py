@@ -0,0 +1,195 @@
+import random
+
+import components
+import ecs
+import snapshot
+from components import *
+from events import *
+from assemblage import Assemblage
+from entity import Entity
+from frontend import NullRenderer, ScriptedInput, PolicyInput, random_policy
+from scheduler import Scheduler
+from terrain import Terrain
+from world import World
+from systems import generate_dungeon, resolve_moves_batch
+
+
+def crowd_attack(monkeypatch, batch):
+    """
+    Three zombies step into the player's cell in the same tick
+    Return how much HP the player lost
+    """
+    monkeypatch.setattr(ecs, "BATCH_RESOLUTION", batch)
+    ecs.Engine.initialize(seed=11, renderer=NullRenderer(),
+                          input=ScriptedInput(""))
+    player = Player.active
+    location = Location.get_component(player)
+    x, y, z = location.x, location.y, Depth.get_component(player).z
+    cells = [(x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+             if (dx, dy) != (0, 0)
+             if Terrain.walkable(z, x + dx, y + dy)
+             if not SpatialIndex.at(z, x + dx, y + dy)]
+    assert len(cells) >= 3
+    zombies = [Assemblage.Zombie(zx, zy, z) for zx, zy in cells[:3]]
+
+    before = HP.get_component(player).value
+    for zombie in zombies:
+        fire(ActorMoved(x, y, zombie))
+    ecs.Engine.settle()
+    return before - HP.get_component(player).value
+
+
+def test_crowd_hits_once_per_attacker(monkeypatch):
+    assert crowd_attack(monkeypatch, True) == 3
+    assert crowd_attack(monkeypatch, False) == 3
+
+
+KEYS = "hjklyubnxz>"
+
+
+def tables():
+    """
+    Every component table, as text, for comparing two games
+    """
+    return [(cc.__name__, sorted((e, str(c)) for e, c in cc.table.items()))
+            for cc in get_all_children(Component)]
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "game.snap")
+    ecs.Engine.initialize(seed=12, renderer=NullRenderer(),
+                          input=PolicyInput(random_policy(12, KEYS)))
+    assert ecs.Engine.main(40) == 40
+    saved = tables()
+    snapshot.save(path)
+    ecs.Engine.input = PolicyInput(random_policy(99, KEYS))
+    assert ecs.Engine.main(60) == 60
+    original = tables(), Scheduler.now, random.random()
+
+    # load over a different game
+    ecs.Engine.initialize(seed=13, renderer=NullRenderer(),
+                          input=PolicyInput(random_policy(13, KEYS)))
+    ecs.Engine.main(5)
+    snapshot.load(path)
+    assert tables() == saved
+
+    ecs.Engine.input = PolicyInput(random_policy(99, KEYS))
+    assert ecs.Engine.main(60) == 60
+    assert (tables(), Scheduler.now, random.random()) == original
+
+
+def test_fork_leaves_parent_alone():
+    def keys(skip=0):
+        policy = random_policy(11, KEYS + "g")
+        for _ in range(skip):
+            policy()
+        return PolicyInput(policy)
+
+    def state():
+        return tables(), Scheduler.now, random.getstate()
+
+    parent = World.new(seed=11, renderer=NullRenderer(), input=keys())
+    with parent:
+        played = ecs.Engine.main(20)
+        assert played == 20
+        before = state()
+
+    fork = parent.fork(input=keys(played))
+    with fork:
+        assert ecs.Engine.main(30) == 30
+        forked = state()
+    assert forked != before
+
+    with parent:
+        assert state() == before
+        # the same keys take the parent where the fork went
+        assert ecs.Engine.main(30) == 30
+        assert state() == forked
+
+
+def zombies_in_a_row(n):
+    """
+    Start a game and put zombies on the first n of n + 1 free floor cells
+    in a row on the player's level
+    Return the zombies, the row's cells and its level
+    """
+    ecs.Engine.initialize(seed=11, renderer=NullRenderer(),
+                          input=ScriptedInput(""))
+    z = Depth.get_component(Player.active).z
+    for y in range(MAP_HEIGHT):
+        for x in range(MAP_WIDTH - n):
+            cells = [(x + i, y) for i in range(n + 1)]
+            if all(Terrain.walkable(z, cx, cy) and not SpatialIndex.at(z, cx, cy)
+                   for cx, cy in cells):
+                zombies = [Assemblage.Zombie(cx, cy, z) for cx, cy in cells[:n]]
+                ecs.Engine.settle()
+                return zombies, cells, z
+    assert False, "no free row"
+
+
+def where(entity):
+    location = Location.get_component(entity)
+    return location.x, location.y
+
+
+def test_batch_moves_follow_chains():
+    zombies, cells, z = zombies_in_a_row(3)
+    resolve_moves_batch([ActorMoved(*cells[i + 1], e)
+                         for i, e in enumerate(zombies)])
+    assert [where(e) for e in zombies] == cells[1:]
+    assert [SpatialIndex.at(z, *cell) for cell in cells[1:]] == \
+        [[e] for e in zombies]
+
+
+def test_batch_moves_chain_behind_a_blocker():
+    zombies, cells, z = zombies_in_a_row(3)
+    # the head of the row stays, so nobody behind it can move up
+    resolve_moves_batch([ActorMoved(*cells[i + 1], e)
+                         for i, e in enumerate(zombies[:2])])
+    assert [where(e) for e in zombies] == cells[:3]
+
+
+def test_batch_moves_swap_cycles_block():
+    zombies, cells, z = zombies_in_a_row(2)
+    a, b = zombies
+    resolve_moves_batch([ActorMoved(*cells[1], a), ActorMoved(*cells[0], b)])
+    assert (where(a), where(b)) == (cells[0], cells[1])
+
+
+def test_batch_moves_contested_cell():
+    zombies, cells, z = zombies_in_a_row(3)
+    a, b, c = zombies
+    # clear the middle cell; a and c both want it
+    fire(Death(b, "damage"))
+    ecs.Engine.settle()
+    resolve_moves_batch([ActorMoved(*cells[1], c), ActorMoved(*cells[1], a)])
+    # the lower entity id gets in, the other stays put
+    assert where(a) == cells[1]
+    assert where(c) == cells[2]
+
+
+def test_dungeon_does_not_depend_on_workers():
+    assert generate_dungeon(4, 7, 1) == generate_dungeon(4, 7, 4)
+
+
+def damage_volley(monkeypatch, batch):
+    """
+    Hit a pack of zombies with repeated and lethal Damage events in one go
+    Return every zombie's HP, None for the dead
+    """
+    monkeypatch.setattr(components, "COLUMNAR_STORAGE", batch)
+    monkeypatch.setattr(ecs, "BATCH_RESOLUTION", batch)
+    zombies, cells, z = zombies_in_a_row(4)
+    assert (HP.store is not None) == batch
+    for target, dmg in zip(zombies + zombies[:2] + zombies[:1],
+                           (1, 2, 3, 5, 1, 1, 2)):
+        fire(Damage(dmg, target))
+    ecs.Engine.settle()
+    return [HP.get_component(e).value if Entity.alive(e) else None
+            for e in zombies]
+
+
+def test_batch_damage_matches_sequential(monkeypatch):
+    hp = damage_volley(monkeypatch, True)
+    assert hp == damage_volley(monkeypatch, False)
+    assert None in hp
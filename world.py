@@ -0,0 +1,262 @@
+"""
+World
+=====
+A whole game's state as one object. The game keeps its state on classes
+(component tables and stores, event queues, the entity allocator, the
+active player and camera, terrain, caches, the scheduler, the RNG...), and
+the classmethod API everything is written against keeps working on that.
+A World holds a set of those class-level values; entering it swaps them
+in and leaving it swaps them back out, so any number of worlds can be kept
+in one process and played in turn:
+
+    a = World.new(seed=1, renderer=NullRenderer(), input=ScriptedInput(""))
+    b = a.clone()
+    with b:
+        Engine.main(max_turns=10)  # a is untouched
+
+Outside of any with block, the classes hold the default world, which is
+what plain Engine.initialize() sets up.
+
+fork() is the cheap way to copy a world: the fork shares everything it
+and its parent haven't changed, so it can be used to look a few turns
+ahead and thrown away, or kept to go back to (undo):
+
+    with world.fork(input=ScriptedInput("z")) as branch:
+        Engine.main(max_turns=3)  # what happens if I siphon this wight?
+        alive = Player.active in HP.table
+"""
+import copy
+import random
+import threading
+from collections import deque
+from constants import *
+from components import *
+from events import *
+from entity import Entity
+from terrain import Terrain
+from pathfinding import FlowField, PathFinder
+from fov import FOV
+from scheduler import Scheduler
+from systems import NearestEnemies, Activity, Dungeon
+from ecs import Engine
+
+
+class World(object):
+    """
+    Only one world can be live at a time, since the live one is the one on
+    the classes; the lock makes threads take turns. Worlds nest: leaving
+    a world brings back whichever one was live before it
+    """
+    lock = threading.RLock()
+    outer = []
+
+    # (owner, attributes) for every piece of class-level game state
+    STATE = [
+        (Entity, ("num_entities", "generations", "free", "shared")),
+        (SpatialIndex, ("cells", "where", "levels", "version")),
+        (EventBus, ("handlers", "batch_handlers", "phases", "dispatching")),
+        (Terrain, ("levels",)),
+        (FlowField, ("fields",)),
+        (PathFinder, ("caches",)),
+        (FOV, ("caches",)),
+        (NearestEnemies, ("levels",)),
+        (Activity, ("level_turns",)),
+        (Dungeon, ("seeds", "levels", "lazy")),
+        (Scheduler, ("now", "heap", "shared", "seq", "current", "kinds")),
+        (Engine, ("seed", "renderer", "input")),
+        (Player, ("active",)),
+        (Camera, ("active",)),
+    ]
+    COMPONENT_STATE = ("table", "just_removed", "store")
+    # the event pools aren't state: a pooled event belongs to no world
+    EVENT_STATE = ("queue", "last", "drained")
+    QUERY_STATE = ("entities_set", "shared", "version", "arrivals")
+    # derived state a fork starts over on instead of sharing
+    CACHES = ((FlowField, "fields"), (PathFinder, "caches"), (FOV, "caches"),
+              (NearestEnemies, "levels"))
+    # dicts a fork layers a CowDict over
+    OVERLAID = ((SpatialIndex, "cells"), (SpatialIndex, "where"),
+                (SpatialIndex, "levels"), (Scheduler, "current"))
+    # state a fork shares with its parent until either of them changes it
+    # (each owner's "shared" flag tells it to copy first)
+    SHARED = ("generations", "free", "heap", "entities_set")
+
+    def __init__(self, state, rng_state):
+        self.state = state
+        self.rng_state = rng_state
+
+    @staticmethod
+    def slots():
+        for owner, names in World.STATE:
+            yield owner, names
+        for component_class in get_all_children(Component):
+            yield component_class, World.COMPONENT_STATE
+        for event_class in get_all_children(Event):
+            yield event_class, World.EVENT_STATE
+        for query in Query.registry:
+            yield query, World.QUERY_STATE
+
+    @staticmethod
+    def capture():
+        """
+        The live world (not a copy: it shares everything with the classes)
+        """
+        state = {}
+        for owner, names in World.slots():
+            for name in names:
+                if name in vars(owner):
+                    state[owner, name] = vars(owner)[name]
+        return World(state, random.getstate())
+
+    @staticmethod
+    def new(**options):
+        """
+        A new world, set up by Engine.initialize(**options)
+        """
+        with World.lock:
+            outside = World.capture()
+            Engine.initialize(**options)
+            world = World.capture()
+            outside.restore()
+        return world
+
+    def restore(self):
+        for owner, names in World.slots():
+            for name in names:
+                if (owner, name) in self.state:
+                    setattr(owner, name, self.state[owner, name])
+        # queries registered after this world was captured start out
+        # matching its tables
+        for query in Query.registry:
+            if (query, "entities_set") not in self.state:
+                query.refresh()
+                query.arrivals = None
+        random.setstate(self.rng_state)
+
+    def clone(self):
+        """
+        A deep copy of this world that can be played independently of it
+        The renderer and input are shared with the copy, as are the
+        queries, classes and functions the state refers to
+        """
+        with World.lock:
+            memo = {id(query): query for query in Query.registry}
+            # a world that is live right now may have moved on from its
+            # state as of the last time it was entered
+            source = World.capture() if self.live() else self
+            for key in ((Engine, "renderer"), (Engine, "input")):
+                if key in source.state:
+                    memo[id(source.state[key])] = source.state[key]
+            state = dict(source.state)
+            for key, value in state.items():
+                # a forked table's entries are bound to other worlds' stores
+                if isinstance(value, CowDict):
+                    state[key] = dict(value.items())
+            return World(copy.deepcopy(state, memo), source.rng_state)
+
+    def fork(self, renderer=None, input=None):
+        """
+        A copy of this world that shares whatever neither of them changes
+        Component tables and the spatial index are layered (see CowDict),
+        and stores, terrain, query sets, entity slots and the scheduler
+        heap are copied by whichever world first writes to them, one column,
+        level or query at a time. Forking itself only copies what is
+        counted per level or per pending event. Caches start out empty in
+        the fork
+        The renderer and input are shared unless others are passed in
+        """
+        with World.lock:
+            source = World.capture() if self.live() else self
+            state = {}
+            for key, value in list(source.state.items()):
+                owner, name = key
+                if key in World.CACHES:
+                    state[key] = {}
+                elif name == "store":
+                    state[key] = value and value.fork()
+                elif name == "table" or key in World.OVERLAID:
+                    continue  # after the stores
+                elif name in World.SHARED:
+                    state[key] = value
+                elif name == "shared":
+                    state[key] = True
+                    source.update(key, True)
+                elif owner is Terrain:
+                    for grid in value.values():
+                        grid.shared = True
+                    state[key] = dict(value)
+                elif name == "queue":
+                    state[key] = deque(copy_event(e) for e in value)
+                elif name == "last":
+                    state[key] = None
+                elif name == "drained":
+                    state[key] = []
+                else:
+                    state[key] = copy_containers(value)
+
+            for key, value in list(source.state.items()):
+                owner, name = key
+                if name != "table" and key not in World.OVERLAID:
+                    continue
+                base = CowDict.frozen(value)
+                if name == "table":
+                    state[key] = CowTable(base, state[owner, "store"])
+                    mine = CowTable(base, source.state.get((owner, "store")))
+                else:
+                    state[key] = CowDict(base)
+                    mine = CowDict(base)
+                if base is not getattr(value, "base", None):
+                    # value is the base now, so the parent can't write to
+                    # it either
+                    source.update(key, mine)
+
+            if renderer is not None:
+                state[Engine, "renderer"] = renderer
+            if input is not None:
+                state[Engine, "input"] = input
+            return World(state, source.rng_state)
+
+    def update(self, key, value):
+        # and on the classes, if they hold this world's value
+        owner, name = key
+        old = self.state[key]
+        self.state[key] = value
+        if vars(owner).get(name, None) is old:
+            setattr(owner, name, value)
+
+    def live(self):
+        return bool(World.outer) and World.outer[-1][1] is self
+
+    def __enter__(self):
+        World.lock.acquire()
+        World.outer.append((World.capture(), self))
+        self.restore()
+        return self
+
+    def __exit__(self, *exc_info):
+        outside, _ = World.outer.pop()
+        # keep what the world became, in case the classes were rebound
+        captured = World.capture()
+        self.state, self.rng_state = captured.state, captured.rng_state
+        outside.restore()
+        World.lock.release()
+
+
+def copy_containers(value):
+    """
+    Copy the dicts, lists, sets and deques in <value>, sharing whatever
+    else they hold
+    """
+    if isinstance(value, dict):
+        return {k: copy_containers(v) for k, v in value.items()}
+    if isinstance(value, (list, set, deque)):
+        return type(value)(copy_containers(v) for v in value)
+    return value
+
+
+def copy_event(event):
+    # queued events are pooled, so each world needs its own
+    twin = Event.__new__(type(event))
+    for slot in type(event).__slots__:
+        setattr(twin, slot, getattr(event, slot))
+    return twin